@@ -0,0 +1,91 @@
+import argparse
+import time
+
+import nrrd
+import numpy as np
+import skimage.filters
+
+import constants
+from biasCorrection import getN4Parameters, estimateBiasFieldShrinked, expandBiasField, estimateBiasFieldLattice, \
+    evaluateBiasFieldLattice, chooseN4Parameters
+
+
+# Benchmark for the speed and accuracy of N4 bias correction configurations
+# The bias field of each configuration is compared against a reference bias field, which should be calculated with the
+# most accurate configuration that is practical (small shrink factor and long iteration schedule). The difference is
+# reported within the body, which is found using Otsu's threshold on the full-resolution image.
+#
+# Example:
+#   python benchmarkBiasCorrection.py fatImage.nrrd --referenceShrinkFactor 2 --shrinkFactors 3 4 --budget 60
+def parseSchedule(text):
+    return [int(x) for x in text.split(',')]
+
+
+def timeBiasField(image, parameters):
+    tic = time.perf_counter()
+    if parameters['biasFieldMethod'] == 'bspline':
+        biasField = evaluateBiasFieldLattice(estimateBiasFieldLattice(image, parameters, prefix=''), image.shape,
+                                             parameters['splineOrder'], constants.biasFieldChunkSize)
+    else:
+        biasField = expandBiasField(estimateBiasFieldShrinked(image, parameters, prefix=''), image.shape)
+    toc = time.perf_counter()
+
+    return biasField, toc - tic
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark N4 bias correction configurations')
+    parser.add_argument('image', help='NRRD image to correct')
+    parser.add_argument('--referenceShrinkFactor', type=int, default=2)
+    parser.add_argument('--referenceSchedule', type=parseSchedule, default=constants.N4Iterations)
+    parser.add_argument('--shrinkFactors', type=int, nargs='+', default=[2, 3, 4])
+    parser.add_argument('--schedules', type=parseSchedule, nargs='+', default=constants.N4Schedules,
+                        help='Iteration schedules separated by commas, e.g. 50,50,50 25,25')
+    parser.add_argument('--method', choices=['ratio', 'bspline'], default=constants.biasFieldMethod,
+                        help='Method used to calculate the bias field at the original image size')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='Also report the configuration chosen for this time budget in seconds')
+    args = parser.parse_args()
+
+    # Bias correction writes no debug files during the benchmark
+    constants.debugBiasCorrection = False
+    constants.nrrdHeaderDict = {}
+
+    image, header = nrrd.read(args.image)
+    image = image.astype(np.float32)
+    bodyMask = image >= skimage.filters.threshold_otsu(image)
+
+    constants.biasFieldMethod = args.method
+
+    referenceParameters = getN4Parameters(shrinkFactor=args.referenceShrinkFactor,
+                                          maximumNumberOfIterations=args.referenceSchedule)
+    referenceField, referenceTime = timeBiasField(image, referenceParameters)
+    logReferenceField = np.log(referenceField[bodyMask])
+
+    print('Reference: shrink factor %i, schedule %s took %f seconds' % (args.referenceShrinkFactor,
+                                                                        args.referenceSchedule, referenceTime))
+    print('%-12s %-20s %10s %14s %14s' % ('Shrink', 'Schedule', 'Time (s)', 'RMS log diff', 'Max rel diff'))
+
+    configurations = [getN4Parameters(shrinkFactor=shrinkFactor, maximumNumberOfIterations=schedule)
+                      for shrinkFactor in args.shrinkFactors for schedule in args.schedules]
+
+    if args.budget:
+        chosenParameters = chooseN4Parameters(image, args.budget, shrinkFactors=args.shrinkFactors,
+                                              schedules=args.schedules)
+        print('Chosen for budget of %f seconds: shrink factor %i, schedule %s' %
+              (args.budget, chosenParameters['shrinkFactor'], chosenParameters['maximumNumberOfIterations']))
+
+    for parameters in configurations:
+        biasField, elapsedTime = timeBiasField(image, parameters)
+
+        logDifference = np.log(biasField[bodyMask]) - logReferenceField
+        RMSLogDifference = np.sqrt(np.mean(logDifference ** 2))
+        maxRelativeDifference = np.max(np.abs(np.expm1(logDifference)))
+
+        print('%-12i %-20s %10.3f %14.6f %14.6f' % (parameters['shrinkFactor'],
+                                                    ','.join(str(x) for x in parameters['maximumNumberOfIterations']),
+                                                    elapsedTime, RMSLogDifference, maxRelativeDifference))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import argparse
+
+import nrrd
+import numpy as np
+
+import constants
+from boundary import boundaryEngines
+from runSegmentation import segmentSlice
+from utils import dice, timeFunction
+
+
+# Benchmark for the speed and accuracy of the boundary engines used to find the region inside the abdominal wall
+# Each slice is segmented up to the fat void mask and then each engine is run on the fat void mask and body mask of the
+# slice. The masks of each engine are compared against the mask from the snake engine with the Dice coefficient. All
+# slices are treated as abdominal slices.
+#
+# Example:
+#   python benchmarkBoundary.py fatImageBC.nrrd --engines snake closing --radius 5 10 20
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark boundary engines against the snake')
+    parser.add_argument('image', help='NRRD bias corrected fat image to segment')
+    parser.add_argument('--engines', nargs='+', default=sorted(boundaryEngines), choices=sorted(boundaryEngines))
+    parser.add_argument('--radius', type=int, nargs='+', default=[constants.boundaryClosingRadius],
+                        help='Disk radius for the closing engine')
+    args = parser.parse_args()
+
+    image, header = nrrd.read(args.image)
+    image = image.astype(np.float32)
+    sliceCount = image.shape[2]
+
+    # Segment each slice with the snake to get the fat void mask, body mask and the reference mask
+    constants.boundaryEngine = 'snake'
+    slices = []
+    for slice in range(sliceCount):
+        results = segmentSlice(image[:, :, slice], slice, {}, diaphragmSuperiorSlice=sliceCount,
+                               umbilicisInferiorSlice=-1, umbilicisSuperiorSlice=-1, umbilicisLeft=0, umbilicisRight=0,
+                               umbilicisCoronal=0)
+        slices.append(results)
+
+    # Engines with a parameter are run once for each value of the parameter
+    runs = []
+    for name in args.engines:
+        if name == 'closing':
+            runs += [('%s (radius %i)' % (name, radius), name, radius) for radius in args.radius]
+        else:
+            runs.append((name, name, None))
+
+    print('%-20s %10s %14s %14s %10s %10s' % ('Engine', 'Total (s)', 'Mean (ms)', 'Max (ms)', 'Mean Dice',
+                                              'Min Dice'))
+    for label, name, radius in runs:
+        if radius is not None:
+            constants.boundaryClosingRadius = radius
+
+        times, dices = [], []
+        for results in slices:
+            (mask, iterations), elapsedTime = timeFunction(boundaryEngines[name], results['fatVoidMask'],
+                                                           results['bodyMask'])
+
+            times.append(elapsedTime)
+            dices.append(dice(mask.astype(bool), results['abdominalMask'].astype(bool)))
+
+        print('%-20s %10.3f %14.3f %14.3f %10.4f %10.4f' % (label, sum(times), np.mean(times) * 1000,
+                                                            max(times) * 1000, np.mean(dices), min(dices)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import argparse
+
+import nrrd
+import numpy as np
+
+import constants
+from utils import kmeans, kmeansHistogram, kmeansHistogramVolume, dice, timeFunction
+
+
+# Benchmark for the speed and accuracy of the two-class K-means methods used to find the fat in each slice
+# The fat mask of each slice from the histogram methods is compared against the fat mask from scikit-learn K-means.
+# Agreement is the fraction of pixels with the same label and Dice is the Dice coefficient of the fat masks.
+#
+# Example:
+#   python benchmarkClustering.py fatImageBC.nrrd --bins 256 1024
+def sklearnMasks(image):
+    masks = np.zeros(image.shape, bool)
+    for slice in range(image.shape[2]):
+        labelOrder, centroids, labels = kmeans(image[:, :, slice], 2, randomState=constants.kMeansRandomState)
+        masks[:, :, slice] = (labels == labelOrder[1])
+
+    return masks
+
+
+def histogramMasks(image, bins):
+    masks = np.zeros(image.shape, bool)
+    for slice in range(image.shape[2]):
+        labelOrder, centroids, labels = kmeansHistogram(image[:, :, slice], 2, bins)
+        masks[:, :, slice] = (labels == labelOrder[1])
+
+    return masks
+
+
+def histogramVolumeMasks(image, bins):
+    labelOrder, centroids, labels = kmeansHistogramVolume(image, 2, bins)
+
+    return labels == labelOrder[0, 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark two-class K-means methods')
+    parser.add_argument('image', help='NRRD image to cluster')
+    parser.add_argument('--bins', type=int, nargs='+', default=[constants.kMeansHistogramBins])
+    args = parser.parse_args()
+
+    image, header = nrrd.read(args.image)
+    image = image.astype(np.float32)
+
+    referenceMasks, referenceTime = timeFunction(sklearnMasks, image)
+    print('scikit-learn K-means of %i slices took %f seconds' % (image.shape[2], referenceTime))
+    print('%-18s %8s %10s %10s %14s %10s' % ('Method', 'Bins', 'Time (s)', 'Speedup', 'Min agreement', 'Min Dice'))
+
+    for bins in args.bins:
+        for name, function in [('histogram', lambda x: histogramMasks(x, bins)),
+                               ('histogramVolume', lambda x: histogramVolumeMasks(x, bins))]:
+            masks, elapsedTime = timeFunction(function, image)
+
+            agreement = [np.mean(masks[:, :, slice] == referenceMasks[:, :, slice]) for slice in range(image.shape[2])]
+            dices = [dice(masks[:, :, slice], referenceMasks[:, :, slice]) for slice in range(image.shape[2])]
+
+            print('%-18s %8i %10.3f %10.1f %14.6f %10.6f' % (name, bins, elapsedTime, referenceTime / elapsedTime,
+                                                             min(agreement), min(dices)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import argparse
+import sys
+import time
+
+import nrrd
+import numpy as np
+
+import constants
+from runSegmentation import segmentSlice, segmentVolume
+from sliceExecutor import executeSlices
+
+
+# Check that segmenting with the morphology done for the whole volume at once gives exactly the same masks as
+# segmenting slice by slice and compare the time each takes. The script exits with an error if any of the masks differ.
+# Without an image, a synthetic phantom is used that has small objects with sizes around each of the area thresholds
+#
+# Example:
+#   python benchmarkMorphology.py
+#   python benchmarkMorphology.py fatImageBC.nrrd --diaphragm 40 --workers 4
+outputNames = ['fatImageMask', 'bodyMask', 'fatVoidMask', 'abdominalMask', 'SCAT', 'VAT']
+
+
+# Add an object with the given number of pixels to the slice, the object is filled row by row in a block of width 4
+def addObject(imageSlice, row, column, size, value):
+    for index in range(size):
+        imageSlice[row + index // 4, column + index % 4] = value
+
+
+# Synthetic phantom of an abdomen with a ring of subcutaneous fat around the abdominal cavity
+# Each slice has fat voids in the subcutaneous fat, fat objects in the abdominal cavity and fat objects outside the
+# body with sizes from one less to one more than the corresponding area threshold. The last slice is empty
+def createPhantom(shape=(128, 128, 7)):
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    random = np.random.RandomState(0)
+    image = np.zeros(shape, np.float32)
+
+    for slice in range(shape[2] - 1):
+        radius = np.hypot((y - 64) / (54 + slice % 3), (x - 64) / 44)
+        imageSlice = 0.2 * (radius < 1) + 0.7 * ((radius > 0.7) & (radius < 1))
+
+        for index, offset in enumerate((-1, 0, 1)):
+            addObject(imageSlice, 16, 52 + 12 * index, constants.thresholdAbdominalFatVoidsArea + offset, 0.2)
+            addObject(imageSlice, 50, 46 + 10 * index, constants.minVATObjectArea + offset, 0.9)
+            addObject(imageSlice, 2, 2 + 8 * index, constants.minSCATObjectArea + offset, 0.9)
+
+        image[:, :, slice] = imageSlice + 0.02 * random.rand(*shape[:2])
+
+    return image
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that volume morphology matches slice by slice segmentation')
+    parser.add_argument('image', nargs='?', help='NRRD bias corrected fat image, a phantom is used if not given')
+    parser.add_argument('--diaphragm', type=int, help='Superior slice of the diaphragm, defaults to all slices')
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.image:
+        image, header = nrrd.read(args.image)
+        image = image.astype(np.float32)
+    else:
+        image = createPhantom()
+
+    kwargs = dict(diaphragmSuperiorSlice=image.shape[2] if args.diaphragm is None else args.diaphragm,
+                  umbilicisInferiorSlice=-1, umbilicisSuperiorSlice=-1, umbilicisLeft=0, umbilicisRight=0,
+                  umbilicisCoronal=0)
+
+    tic = time.perf_counter()
+    sliceOutputs, sliceStats = executeSlices(segmentSlice, image, {name: bool for name in outputNames},
+                                             workers=args.workers, blockSize=constants.segmentationBlockSize,
+                                             **kwargs)
+    toc = time.perf_counter()
+    print('Slice by slice segmentation of %i slices took %f seconds' % (image.shape[2], toc - tic))
+
+    tic = time.perf_counter()
+    volumeOutputs, volumeStats = segmentVolume(image, args.workers, constants.segmentationBlockSize, None, **kwargs)
+    toc = time.perf_counter()
+    print('Volume segmentation of %i slices took %f seconds' % (image.shape[2], toc - tic))
+
+    differences = {name: int(np.count_nonzero(sliceOutputs[name] != volumeOutputs[name])) for name in outputNames}
+    for name in outputNames:
+        print('%-14s %10i pixels differ' % (name, differences[name]))
+
+    if any(differences.values()):
+        sys.exit('Volume morphology does not match slice by slice segmentation')
+
+
+if __name__ == '__main__':
+    main()
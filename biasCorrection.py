@@ -1,38 +1,111 @@
+import concurrent.futures
+import json
 import os
+import time
 
 import SimpleITK as sitk
-import nrrd
 import numpy as np
 import scipy.ndimage.interpolation
+import scipy.special
 import skimage.filters
 import skimage.transform
 import skimage.exposure
 
 import constants
+from debugWriter import writeDebug, isDebugEnabled
 
 
-# Get resulting path for debug files
-def getDebugPath(prefix, filename):
-    return os.path.join(constants.pathDir, 'debug', prefix, filename)
+# Get the parameters for N4 bias correction
+# The default parameters are retrieved from the constants and any keyword arguments given will override the defaults
+def getN4Parameters(**kwargs):
+    parameters = {
+        'shrinkFactor': constants.shrinkFactor,
+        'maskMethod': 'otsu',
+        'maximumNumberOfIterations': list(constants.N4Iterations),
+        'convergenceThreshold': constants.N4ConvergenceThreshold,
+        'numberOfControlPoints': list(constants.N4ControlPoints),
+        'splineOrder': constants.N4SplineOrder,
+        'biasFieldFullWidthAtHalfMaximum': constants.N4BiasFieldFullWidthAtHalfMaximum,
+        'wienerFilterNoise': constants.N4WienerFilterNoise,
+        'numberOfHistogramBins': constants.N4HistogramBins,
+        'biasFieldMethod': constants.biasFieldMethod,
+        'cropToBody': constants.N4CropToBody,
+        'cropMargin': constants.N4CropMargin,
+    }
 
+    for key, value in kwargs.items():
+        if key not in parameters:
+            raise TypeError('Invalid N4 parameter: %s' % key)
 
-# Given an image and a shrink factor, the image is corrected via N4 bias correction method
-def correctBias(image, shrinkFactor, prefix):
-    # If debug bias correction is turned on, then create the directory where the debug files will be saved
-    # The makedirs command is in try/catch because if it already exists, it will throw an exception and we just want
-    # to continue in that case
-    if constants.debugBiasCorrection:
-        try:
-            os.makedirs(getDebugPath(prefix, ''))
-        except os.error:
-            pass
-
-    if constants.debugBiasCorrection:
-        nrrd.write(getDebugPath(prefix, 'image.nrrd'), image, constants.nrrdHeaderDict)
-
-    # Shrink image by shrinkFactor to make the bias correction quicker
-    # Use resample to linearly interpolate between pixel values
-    shrinkedImage = scipy.ndimage.interpolation.zoom(image, 1 / shrinkFactor)
+        parameters[key] = value
+
+    return parameters
+
+
+# Create the N4 bias field correction filter with the given parameters
+# The number of fitting levels is the length of maximumNumberOfIterations. Each fitting level stops early when the
+# convergence measurement is below the convergence threshold
+# If numberOfThreads is None, the global default number of threads for SimpleITK is used
+def createN4Filter(parameters, numberOfThreads=None):
+    N4Filter = sitk.N4BiasFieldCorrectionImageFilter()
+    N4Filter.SetMaximumNumberOfIterations([int(x) for x in parameters['maximumNumberOfIterations']])
+    N4Filter.SetConvergenceThreshold(parameters['convergenceThreshold'])
+    N4Filter.SetNumberOfControlPoints([int(x) for x in parameters['numberOfControlPoints']])
+    N4Filter.SetSplineOrder(int(parameters['splineOrder']))
+    N4Filter.SetBiasFieldFullWidthAtHalfMaximum(parameters['biasFieldFullWidthAtHalfMaximum'])
+    N4Filter.SetWienerFilterNoise(parameters['wienerFilterNoise'])
+    N4Filter.SetNumberOfHistogramBins(int(parameters['numberOfHistogramBins']))
+
+    if numberOfThreads:
+        N4Filter.SetNumberOfThreads(int(numberOfThreads))
+
+    return N4Filter
+
+
+# Shrink image by shrinkFactor to make the bias correction quicker
+# Use resample to linearly interpolate between pixel values
+# Float32 images are prefiltered in float32 rather than float64 to halve the size of the temporary prefiltered image
+def shrinkImage(image, shrinkFactor):
+    if image.dtype == np.float32:
+        prefilteredImage = scipy.ndimage.spline_filter(image, output=np.float32)
+        return scipy.ndimage.interpolation.zoom(prefilteredImage, 1 / shrinkFactor, prefilter=False)
+
+    return scipy.ndimage.interpolation.zoom(image, 1 / shrinkFactor)
+
+
+# Perform Otsu's thresholding method on images to get a mask for N4 correction bias
+# According to Sled's paper (author of N3 bias correction), the mask is to remove infinity values
+# from log-space (log(0) = infinity)
+def createMask(shrinkedImage, maskMethod):
+    if maskMethod != 'otsu':
+        raise TypeError('Invalid mask method: %s' % maskMethod)
+
+    imageMaskThresh = skimage.filters.threshold_otsu(shrinkedImage)
+    return (shrinkedImage >= imageMaskThresh).astype(np.uint8)
+
+
+# Get the bounding box of the body across all slices, with a margin of voxels added on each side
+# The body is found with Otsu's threshold, the same as the mask for N4 bias correction
+# Returns a tuple of slices that can be used to index the image
+def getBodyRegion(image, margin):
+    bodyMask = createMask(image, 'otsu').astype(bool)
+
+    # Volume without any body is not cropped
+    if not bodyMask.any():
+        return tuple(slice(None) for _ in image.shape)
+
+    region = []
+    for axis in range(image.ndim):
+        indices = np.flatnonzero(bodyMask.any(axis=tuple(x for x in range(image.ndim) if x != axis)))
+        region.append(slice(max(int(indices[0]) - margin, 0), min(int(indices[-1]) + 1 + margin, image.shape[axis])))
+
+    return tuple(region)
+
+
+# Shrink the image and perform N4 bias correction on the shrinked image
+# Returns the shrinked image, the corrected shrinked image and the N4 filter, which contains the B-spline bias field
+def runN4(image, parameters, prefix, numberOfThreads=None):
+    shrinkedImage = shrinkImage(image, parameters['shrinkFactor'])
 
     # Since the image is shrinked, this means the spacing between pixels increased by the shrink factor
     # Adjust this in the NRRD header
@@ -40,26 +113,28 @@ def correctBias(image, shrinkFactor, prefix):
     # nrrdHeaderDictShrinked['space directions'] = list(
     #     x * shrinkFactor for x in nrrdHeaderDictShrinked['space directions'])
 
-    if constants.debugBiasCorrection:
-        nrrd.write(getDebugPath(prefix, 'imageShrinked.nrrd'), shrinkedImage, nrrdHeaderDictShrinked)
+    writeDebug(constants.debugBiasCorrection, prefix, 'imageShrinked.nrrd', shrinkedImage, nrrdHeaderDictShrinked)
 
-    # Perform Otsu's thresholding method on images to get a mask for N4 correction bias
-    # According to Sled's paper (author of N3 bias correction), the mask is to remove infinity values
-    # from log-space (log(0) = infinity)
-    imageMaskThresh = skimage.filters.threshold_otsu(shrinkedImage)
-    imageMask = (shrinkedImage >= imageMaskThresh).astype(np.uint8)
+    imageMask = createMask(shrinkedImage, parameters['maskMethod'])
 
-    if constants.debugBiasCorrection:
-        nrrd.write(getDebugPath(prefix, 'imageMask.nrrd'), imageMask, nrrdHeaderDictShrinked)
+    writeDebug(constants.debugBiasCorrection, prefix, 'imageMask.nrrd', imageMask, nrrdHeaderDictShrinked)
 
     # Apply N4 bias field correction to the shrinked image
     shrinkedImageITK = sitk.GetImageFromArray(shrinkedImage)
     imageMaskITK = sitk.GetImageFromArray(imageMask)
-    correctedImageITK = sitk.N4BiasFieldCorrection(shrinkedImageITK, imageMaskITK)
+    N4Filter = createN4Filter(parameters, numberOfThreads)
+    correctedImageITK = N4Filter.Execute(shrinkedImageITK, imageMaskITK)
     correctedImage = sitk.GetArrayFromImage(correctedImageITK)
 
-    if constants.debugBiasCorrection:
-        nrrd.write(getDebugPath(prefix, 'correctedImageShrinked.nrrd'), correctedImage, nrrdHeaderDictShrinked)
+    writeDebug(constants.debugBiasCorrection, prefix, 'correctedImageShrinked.nrrd', correctedImage,
+               nrrdHeaderDictShrinked)
+
+    return shrinkedImage, correctedImage, N4Filter
+
+
+# Calculate the bias field of an image at the shrinked resolution using N4 bias correction
+def estimateBiasFieldShrinked(image, parameters, prefix, numberOfThreads=None):
+    shrinkedImage, correctedImage, N4Filter = runN4(image, parameters, prefix, numberOfThreads)
 
     # Replace all 0s in shrinked image with very small number
     # Prevents infinity values when calculating shrinked bias field, prevents divide by zero issues
@@ -69,29 +144,272 @@ def correctBias(image, shrinkFactor, prefix):
     # v(x) / u(x) = f(x)
     biasFieldShrinked = shrinkedImage / correctedImage
 
-    if constants.debugBiasCorrection:
-        nrrd.write(getDebugPath(prefix, 'biasFieldShrinked.nrrd'), biasFieldShrinked, nrrdHeaderDictShrinked)
+    writeDebug(constants.debugBiasCorrection, prefix, 'biasFieldShrinked.nrrd', biasFieldShrinked,
+               constants.nrrdHeaderDict)
+
+    return biasFieldShrinked
+
+
+# Calculate the B-spline basis matrix for a uniform B-spline with the given number of control points and order
+# The parametric coordinates u are between 0 and 1 and span the entire B-spline domain, the same as ITK
+# Each row is the weight of each control point for one parametric coordinate
+def bsplineBasis(u, numberOfControlPoints, splineOrder):
+    # Position of each coordinate in units of B-spline spans
+    t = np.asarray(u, dtype=np.float64)[:, None] * (numberOfControlPoints - splineOrder)
+
+    # The weight of control point j is the cardinal B-spline evaluated at t - j + splineOrder
+    x = t - np.arange(numberOfControlPoints)[None, :] + splineOrder
+
+    # Cardinal B-spline of the given order using the truncated power formula
+    basis = np.zeros(x.shape)
+    for i in range(splineOrder + 2):
+        basis += (-1) ** i * scipy.special.comb(splineOrder + 1, i) * np.maximum(x - i, 0) ** splineOrder
+
+    return basis / scipy.special.factorial(splineOrder)
+
+
+# Calculate the control point lattice of the N4 log bias field for an image
+# The log bias field from N4 is a smooth B-spline. SimpleITK does not expose the control points directly, so the log
+# bias field is evaluated at the shrinked resolution and the control points are solved for with least squares. Since
+# the field is a B-spline with the same control points, this reproduces the field exactly
+def estimateBiasFieldLattice(image, parameters, prefix, numberOfThreads=None):
+    shrinkedImage, correctedImage, N4Filter = runN4(image, parameters, prefix, numberOfThreads)
+
+    if isDebugEnabled(constants.debugBiasCorrection, 'biasFieldShrinked'):
+        shrinkedImageITK = sitk.GetImageFromArray(shrinkedImage)
+        writeDebug(constants.debugBiasCorrection, prefix, 'biasFieldShrinked.nrrd',
+                   np.exp(sitk.GetArrayFromImage(N4Filter.GetLogBiasFieldAsImage(shrinkedImageITK))),
+                   constants.nrrdHeaderDict)
+
+    # Number of spans is doubled at each fitting level, ITK dimensions are the reverse of NumPy dimensions
+    splineOrder = int(parameters['splineOrder'])
+    levels = len(parameters['maximumNumberOfIterations'])
+    numberOfControlPoints = [(int(x) - splineOrder) * 2 ** (levels - 1) + splineOrder
+                             for x in reversed(parameters['numberOfControlPoints'])]
+
+    # The shrinked image may have fewer slices than control points, so the log bias field is evaluated on a grid that
+    # spans the same region as the shrinked image with at least twice as many points as control points in each dimension
+    size = [max(x, 2 * count) for x, count in zip(shrinkedImage.shape, numberOfControlPoints)]
+    spacing = [(x - 1) / (y - 1) for x, y in zip(shrinkedImage.shape, size)]
+    referenceImageITK = sitk.Image(size[::-1], sitk.sitkFloat32)
+    referenceImageITK.SetSpacing(spacing[::-1])
+    logBiasField = sitk.GetArrayFromImage(N4Filter.GetLogBiasFieldAsImage(referenceImageITK))
+
+    # Solve for the control points one dimension at a time since the B-spline is separable
+    lattice = logBiasField.astype(np.float64)
+    for axis, (size, count) in enumerate(zip(logBiasField.shape, numberOfControlPoints)):
+        inverseBasis = np.linalg.pinv(bsplineBasis(np.linspace(0.0, 1.0, size), count, splineOrder))
+        lattice = np.moveaxis(np.tensordot(inverseBasis, lattice, axes=(1, axis)), 0, axis)
+
+    return lattice.astype(np.float32)
+
+
+# Evaluate the bias field from the control point lattice of the log bias field at the given shape
+# The field is evaluated in chunks of slices along the last axis to limit the memory used
+def evaluateBiasFieldLattice(lattice, shape, splineOrder, chunkSize=16):
+    bases = [bsplineBasis(np.linspace(0.0, 1.0, size), count, splineOrder).astype(np.float32)
+             for size, count in zip(shape, lattice.shape)]
+
+    # Evaluate the first two dimensions for all control points along the last dimension
+    partialField = np.einsum('abc,ia,jb->ijc', lattice, bases[0], bases[1])
 
+    biasField = np.empty(shape, dtype=np.float32)
+    for start in range(0, shape[2], chunkSize):
+        stop = min(start + chunkSize, shape[2])
+        np.exp(partialField @ bases[2][start:stop].T, out=biasField[:, :, start:stop])
+
+    # Clip all values below 0.50 to 0.50. We know the biasField should not be changing items by more than a factor
+    # of two
+    np.maximum(biasField, 0.50, out=biasField)
+
+    return biasField
+
+
+# Expand the shrinked bias field to the given shape of the original image
+# dtype is the data type of the expanded bias field, if None then float64 is used
+def expandBiasField(biasFieldShrinked, shape, dtype=None):
     # TODO This causes the first and last slice of the biasField to be all 0s
     # Since the image was shrinked when performing bias correction to speed up the process, the bias field is
     # now expanded to the original image size
-    biasField = scipy.ndimage.interpolation.zoom(biasFieldShrinked, np.array(image.shape) / biasFieldShrinked.shape)
+    biasField = scipy.ndimage.interpolation.zoom(biasFieldShrinked, np.array(shape) / biasFieldShrinked.shape,
+                                                 output=dtype)
 
     # Clip all values below 0.50 to 0.50. We know the biasField should not be changing items by more than a factor
     # of two
     biasField[biasField < 0.50] = 0.50
 
-    if constants.debugBiasCorrection:
-        nrrd.write(getDebugPath(prefix, 'biasField.nrrd'), biasField, constants.nrrdHeaderDict)
+    return biasField
+
+
+# Given an image and a shrink factor, the image is corrected via N4 bias correction method
+# If a cache is given, the shrinked bias field is retrieved from the cache when the same image was corrected before
+# with the same parameters. Otherwise, the bias field is calculated and stored in the cache
+# Any parameters for N4 bias correction given in N4Parameters will override the defaults, see getN4Parameters
+# numberOfThreads is the number of threads used by N4, if None the global default for SimpleITK is used
+# If lowMemory is True, the bias field is calculated in float32 and the corrected image is calculated in place in the
+# bias field buffer, so no other full size temporary arrays are created. The corrected image is float32
+def correctBias(image, shrinkFactor, prefix, cache=None, N4Parameters=None, numberOfThreads=None, lowMemory=False):
+    # Debug files are written in the background and the directory for the debug files is created by the writer
+    writeDebug(constants.debugBiasCorrection, prefix, 'image.nrrd', image, constants.nrrdHeaderDict)
+
+    # Parameters that affect the resulting bias field, these are used along with the image for the cache key
+    parameters = getN4Parameters(**dict(N4Parameters or {}, shrinkFactor=shrinkFactor))
+
+    cacheKey = cache.key(image, parameters) if cache else None
+    cacheEntry = cache.get(cacheKey) if cache else None
+
+    # When cropping to the body, N4 is only run within the bounding box of the body and the background outside of the
+    # bounding box is left uncorrected. This is quicker and uses less memory since much of the image is background
+    if parameters['cropToBody']:
+        region = getBodyRegion(image, parameters['cropMargin'])
+    else:
+        region = tuple(slice(None) for _ in image.shape)
+
+    croppedImage = image[region]
+
+    if parameters['biasFieldMethod'] == 'bspline':
+        # Evaluate the B-spline of the log bias field directly at the original image size
+        # Only the control point lattice needs to be cached in this case
+        if cacheEntry is not None:
+            lattice = cacheEntry['lattice']
+        else:
+            lattice = estimateBiasFieldLattice(croppedImage, parameters, prefix, numberOfThreads)
+
+            if cache:
+                cache.put(cacheKey, {'lattice': lattice})
+
+        biasField = evaluateBiasFieldLattice(lattice, croppedImage.shape, parameters['splineOrder'],
+                                             constants.biasFieldChunkSize)
+    elif parameters['biasFieldMethod'] == 'ratio':
+        if cacheEntry is not None:
+            biasFieldShrinked = cacheEntry['biasFieldShrinked']
+        else:
+            biasFieldShrinked = estimateBiasFieldShrinked(croppedImage, parameters, prefix, numberOfThreads)
+
+            if cache:
+                cache.put(cacheKey, {'biasFieldShrinked': biasFieldShrinked.astype(np.float32)})
+
+        biasField = expandBiasField(biasFieldShrinked, croppedImage.shape, np.float32 if lowMemory else None)
+    else:
+        raise TypeError('Invalid bias field method: %s' % parameters['biasFieldMethod'])
+
+    # Paste the bias field of the cropped region back into a bias field of the entire image
+    if croppedImage.shape != image.shape:
+        croppedBiasField = biasField
+        biasField = np.ones(image.shape, dtype=croppedBiasField.dtype)
+        biasField[region] = croppedBiasField
+
+    # Bias field is queued before it is overwritten when correcting in place
+    writeDebug(constants.debugBiasCorrection, prefix, 'biasField.nrrd', biasField,
+               constants.nrrdHeaderDict)
 
-    # Get the actual image by dividing original image by the bias field
-    # u(x) = v(x) / f(x)
-    correctedImage = image / biasField
+    if lowMemory:
+        # Divide and rescale in place, reusing the bias field buffer for the corrected image
+        correctedImage = np.divide(image, biasField, out=biasField)
 
-    # # Rescale corrected image so it is within bounds [0, 1]
-    correctedImage = skimage.exposure.rescale_intensity(correctedImage, out_range=(0, 1))
+        minimum, maximum = correctedImage.min(), correctedImage.max()
+        correctedImage -= minimum
+        if maximum > minimum:
+            correctedImage *= 1 / (maximum - minimum)
+    else:
+        # Get the actual image by dividing original image by the bias field
+        # u(x) = v(x) / f(x)
+        correctedImage = image / biasField
 
-    if constants.debugBiasCorrection:
-        nrrd.write(getDebugPath(prefix, 'correctedImage.nrrd'), correctedImage, constants.nrrdHeaderDict)
+        # # Rescale corrected image so it is within bounds [0, 1]
+        correctedImage = skimage.exposure.rescale_intensity(correctedImage, out_range=(0, 1))
+
+    writeDebug(constants.debugBiasCorrection, prefix, 'correctedImage.nrrd', correctedImage,
+               constants.nrrdHeaderDict)
 
     return correctedImage
+
+
+# Correct multiple images at the same time, such as the fat and water images of a subject or images from several
+# subjects. Each image is corrected on its own thread and the threads for N4 are split evenly between the images.
+# Since SimpleITK releases the GIL while running N4, the images are corrected in parallel
+# totalThreads is the number of threads to split between the images, if None then the number of CPUs is used
+# Returns a list of the corrected images in the same order as the given images
+def correctBiasMany(images, shrinkFactor, prefixes, cache=None, N4Parameters=None, totalThreads=None,
+                    lowMemory=False):
+    if len(images) != len(prefixes):
+        raise TypeError('Number of images and prefixes must be the same')
+
+    if not images:
+        return []
+
+    totalThreads = totalThreads or os.cpu_count() or 1
+    numberOfThreads = max(totalThreads // len(images), 1)
+    workers = min(len(images), totalThreads)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(correctBias, image, shrinkFactor, prefix, cache, N4Parameters, numberOfThreads,
+                                   lowMemory) for image, prefix in zip(images, prefixes)]
+
+        return [future.result() for future in futures]
+
+
+# Choose the N4 parameters that give the most accurate correction while fitting in the time budget (seconds)
+# A short calibration run at the largest shrink factor measures the time per voxel per iteration on this machine. This
+# is used to predict the time of each candidate shrink factor and iteration schedule. The predicted time is an upper
+# bound since fitting levels may stop early once converged.
+# Candidates are tried from most to least accurate: smaller shrink factors first and then longer schedules. If no
+# candidate fits in the budget, the quickest candidate is returned
+# When cropping to the body, the calibration and predictions use the cropped image since that is what N4 is run on
+# If a cache is given, the chosen parameters are stored in it by the size of the image, the budget and the number of
+# threads. Later runs reuse them without calibrating, so the parameters, and the bias field cached for them, do not
+# change from run to run due to differences in the measured time
+def chooseN4Parameters(image, timeBudget, shrinkFactors=(1, 2, 3, 4), schedules=None, calibrationIterations=10,
+                       numberOfThreads=None, cache=None):
+    if schedules is None:
+        schedules = constants.N4Schedules
+
+    defaultParameters = getN4Parameters()
+    if defaultParameters['cropToBody']:
+        image = image[getBodyRegion(image, defaultParameters['cropMargin'])]
+
+    # Key only depends on the size of the image and not its contents, the shape is hashed in place of the image
+    if cache:
+        cacheKey = cache.key(np.array(image.shape), {
+            'timeBudget': timeBudget,
+            'shrinkFactors': sorted(shrinkFactors),
+            'schedules': [list(schedule) for schedule in schedules],
+            'calibrationIterations': calibrationIterations,
+            'numberOfThreads': numberOfThreads,
+            'defaultParameters': defaultParameters,
+        })
+        cacheEntry = cache.get(cacheKey)
+
+        if cacheEntry is not None:
+            return json.loads(str(cacheEntry['parameters']))
+
+    # Calibrate by running a single fitting level with no early stopping at the largest shrink factor
+    calibrationParameters = getN4Parameters(shrinkFactor=max(shrinkFactors),
+                                            maximumNumberOfIterations=[calibrationIterations],
+                                            convergenceThreshold=0.0)
+    shrinkedImage = shrinkImage(image, calibrationParameters['shrinkFactor'])
+    imageMask = createMask(shrinkedImage, calibrationParameters['maskMethod'])
+
+    tic = time.perf_counter()
+    createN4Filter(calibrationParameters, numberOfThreads).Execute(sitk.GetImageFromArray(shrinkedImage),
+                                                                   sitk.GetImageFromArray(imageMask))
+    toc = time.perf_counter()
+
+    timePerVoxelIteration = (toc - tic) / (shrinkedImage.size * calibrationIterations)
+
+    candidates = []
+    for shrinkFactor in sorted(shrinkFactors):
+        voxels = np.prod(np.round(np.array(image.shape) / shrinkFactor))
+
+        for schedule in schedules:
+            predictedTime = timePerVoxelIteration * voxels * sum(schedule)
+            candidates.append((predictedTime, getN4Parameters(shrinkFactor=shrinkFactor,
+                                                              maximumNumberOfIterations=list(schedule))))
+
+    chosenParameters = next((parameters for predictedTime, parameters in candidates if predictedTime <= timeBudget),
+                            min(candidates, key=lambda x: x[0])[1])
+
+    if cache:
+        cache.put(cacheKey, {'parameters': np.array(json.dumps(chosenParameters))})
+
+    return chosenParameters
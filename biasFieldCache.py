@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+# Cache of bias fields from N4 bias correction stored in a directory
+# Each entry is a compressed NumPy .npz file named by the hash of the input image and the parameters used for the
+# correction. Since the name depends on the content, any change to the input image or parameters results in a new entry
+# and old entries are never used. When the total size of the cache is above the maximum size, the least recently used
+# entries are removed.
+class BiasFieldCache:
+    def __init__(self, directory, maxSize):
+        self.directory = directory
+        self.maxSize = maxSize
+
+        os.makedirs(directory, exist_ok=True)
+
+    # Calculate the key for an image and the parameters used to correct it
+    # Parameters must be a JSON serializable dictionary
+    # The image is hashed in its existing memory order so that a Fortran ordered volume is not copied, the order is part
+    # of the key. Only images that are not contiguous in either order are copied
+    @staticmethod
+    def key(image, parameters):
+        if image.flags.f_contiguous and not image.flags.c_contiguous:
+            order, data = 'F', image.T
+        else:
+            order, data = 'C', np.ascontiguousarray(image)
+
+        hash_ = hashlib.sha1()
+        hash_.update(str(image.shape).encode('ascii'))
+        hash_.update(image.dtype.str.encode('ascii'))
+        hash_.update(order.encode('ascii'))
+        hash_.update(data.data)
+        hash_.update(json.dumps(parameters, sort_keys=True).encode('ascii'))
+
+        return hash_.hexdigest()
+
+    def getPath(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    # Retrieve the arrays for a key, None is returned if the key is not in the cache
+    def get(self, key):
+        path = self.getPath(key)
+
+        try:
+            with np.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (OSError, ValueError):
+            return None
+
+        # Update the modification time so that the entry is marked as recently used
+        os.utime(path)
+
+        return arrays
+
+    # Store the arrays for a key in the cache and remove old entries if the cache is too large
+    def put(self, key, arrays):
+        # Write to a temporary file first and then move it so that a partially written entry is never read
+        fd, tempPath = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with os.fdopen(fd, 'wb') as fh:
+            np.savez_compressed(fh, **arrays)
+
+        os.replace(tempPath, self.getPath(key))
+
+        self.evict()
+
+    # Remove the least recently used entries until the total size of the cache is at most the maximum size
+    def evict(self):
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.npz'):
+                # Entry may be removed by another process or thread evicting at the same time
+                try:
+                    stat = os.stat(os.path.join(self.directory, filename))
+                except FileNotFoundError:
+                    continue
+
+                entries.append((stat.st_mtime, stat.st_size, filename))
+
+        totalSize = sum(size for _, size, _ in entries)
+
+        for _, size, filename in sorted(entries):
+            if totalSize <= self.maxSize:
+                break
+
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+
+            totalSize -= size
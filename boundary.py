@@ -0,0 +1,106 @@
+import numpy as np
+import scipy.ndimage
+import skimage.draw
+import skimage.measure
+import skimage.transform
+
+import constants
+from snake import activeContours, scaleContour, resampleContour, getBodyContour
+
+
+# Each boundary engine finds the mask of the region inside the abdominal or thoracic wall of a slice from the fat void
+# mask and body mask of the slice. The engines have the same parameters, so they can be swapped per run with
+# constants.boundaryEngine, but each engine finds the wall differently and the resulting masks are not the same
+# If state is given, an engine may reuse results from the previous slice in the state and save its results for the
+# next slice
+# Returns the mask as a uint8 image and the number of iterations the engine took, which is 0 for non-iterative engines
+
+
+# Fit an active contour (snake) starting from the outline of the body to the edges of the fat void mask
+# The outline of the largest object in the body mask is the body outline, which is resampled to constants.snakePoints
+# points if given
+# If state is given, the snake is started from the snake of the previous slice in the state, scaled to the body outline
+# of this slice, rather than the body outline itself. The snake and body outline of this slice are saved in the state
+# for the next slice
+def snakeBoundary(fatVoidMask, bodyMask, state=None):
+    bodyContour = getBodyContour(bodyMask, constants.snakePoints)
+
+    # The outline of neighbouring slices is similar, so starting from the snake of the previous slice requires far fewer
+    # iterations than starting from the body outline
+    if state is not None and 'snakeContour' in state:
+        initialContour = scaleContour(state['snakeContour'], state['bodyContour'], bodyContour)
+    else:
+        initialContour = bodyContour
+
+    activeContour = activeContours[constants.snakeEngine]
+    snakeParameters = dict(alpha=0.70, beta=0.01, gamma=0.1, maxPixelMove=1.0, wLine=0.0, wEdge=5.0, convergence=0.1)
+    maxIterations = 2500
+    coarseIterations = 0
+
+    # With more than one pyramid level, the snake is first fit to the fat void mask downsampled by the mean of each
+    # block of pixels. The fitted snake is then refined at full resolution for a few iterations. Each pixel of the
+    # downsampled image is at the center of its block in the full image
+    # The downsampled snake has fewer points so that the spacing of the points in pixels stays the same, otherwise the
+    # points are crowded together and the snake oscillates rather than converging
+    if constants.pyramidLevels > 1:
+        factor = 2 ** (constants.pyramidLevels - 1)
+        numberOfPoints = len(initialContour)
+
+        coarseImage = skimage.transform.downscale_local_mean(fatVoidMask.astype(float), (factor, factor))
+        coarseContour = resampleContour(initialContour, max(numberOfPoints // factor, 16))
+        coarseContour, coarseIterations = activeContour(coarseImage, (coarseContour - (factor - 1) / 2) / factor,
+                                                        maxIterations=maxIterations, **snakeParameters)
+
+        initialContour = resampleContour(coarseContour * factor + (factor - 1) / 2, numberOfPoints)
+        maxIterations = constants.pyramidRefineIterations
+
+    # Perform active contour snake algorithm to get outline of the mask
+    # The number of iterations includes the iterations of the downsampled snake
+    snakeContour, iterations = activeContour(fatVoidMask.astype(np.uint8) * 255, initialContour,
+                                             maxIterations=maxIterations, **snakeParameters)
+    iterations += coarseIterations
+
+    if state is not None:
+        state['snakeContour'] = snakeContour
+        state['bodyContour'] = bodyContour
+
+    # Draw snake contour on mask variable
+    # Two options, polygon fills in the area and polygon_perimeter only draws the perimeter
+    # Perimeter is good for testing while polygon is the general use one
+    mask = np.zeros(fatVoidMask.shape, np.uint8)
+    rr, cc = skimage.draw.polygon(snakeContour[:, 0], snakeContour[:, 1])
+    # rr, cc = skimage.draw.polygon_perimeter(snakeContour[:, 0], snakeContour[:, 1])
+    mask[cc, rr] = 1
+
+    return mask, iterations
+
+
+# Close the gaps between the fat voids with a disk of the given radius and fill the holes
+# The closing is done with the Euclidean distance transform, so the cost does not depend on the radius. Only the largest
+# closed object inside the body is kept, which is the region inside the wall. This is not iterative and does not need an
+# initial contour, but the gaps in the wall that are wider than twice the radius are not bridged
+# noinspection PyUnusedLocal
+def closingBoundary(fatVoidMask, bodyMask, state=None):
+    radius = constants.boundaryClosingRadius
+
+    # Dilation is every pixel within the radius of the fat voids, erosion of the dilation is every pixel further than
+    # the radius from the background of the dilation. Pixels outside the image are treated as part of the dilation
+    dilatedMask = scipy.ndimage.distance_transform_edt(np.logical_not(fatVoidMask)) <= radius
+    closedMask = scipy.ndimage.distance_transform_edt(dilatedMask) > radius
+
+    closedMask = scipy.ndimage.binary_fill_holes(closedMask)
+    closedMask = np.logical_and(closedMask, bodyMask)
+
+    labels = skimage.measure.label(closedMask)
+    mask = np.zeros(fatVoidMask.shape, np.uint8)
+    if labels.max() > 0:
+        mask[labels == np.argmax(np.bincount(labels.ravel())[1:]) + 1] = 1
+
+    return mask, 0
+
+
+# Boundary engines that can be selected
+boundaryEngines = {
+    'snake': snakeBoundary,
+    'closing': closingBoundary,
+}
@@ -10,10 +10,31 @@ version = '1.0.1'
 showBodyMask = False
 
 # Debug option to save intermediate steps while running algorithm
-debug = True
+debug = False
 
 # Debug option to save intermediate steps for N4 bias correction in directory of the subject
-debugBiasCorrection = True
+debugBiasCorrection = False
+
+# Names of the debug files to save when debug or debugBiasCorrection is on, the name is the filename without the
+# extension, e.g. {'biasField', 'bodyMask'}
+# None will save all debug files
+debugArtifacts = None
+
+# Encoding of the debug NRRD files, either raw or gzip
+# gzip files are smaller but take longer to write
+debugEncoding = 'raw'
+
+# Maximum number of debug files waiting to be written by the background writer
+# Each waiting file holds a copy of its array in memory, the algorithm waits when this many files are waiting
+debugQueueSize = 4
+
+# Number of threads to use when reading the DICOM headers from a directory
+# None will use the default number of workers based on the number of CPUs, 1 will read the files serially
+DICOMLoadWorkers = None
+
+# Filename of the DICOM header index that is stored in the directory of the subject
+# The index is used to only read new or changed DICOM files when loading a subject again
+DICOMIndexFilename = 'dicomIndex.sqlite'
 
 # Factor to shrink the volume by when applying the N4 ITK bias correction algorithm
 # Should be a number between 1-4
@@ -23,9 +44,164 @@ debugBiasCorrection = True
 # 1 - fatUpper took 690s, so total would be approx. 12 * 4 = 2760s ~= 46min
 shrinkFactor = 4
 
+# Maximum number of iterations for each fitting level of the N4 ITK bias correction algorithm
+# The number of fitting levels is the length of the list
+N4Iterations = [50, 50, 50, 50]
+
+# Convergence threshold for the N4 ITK bias correction algorithm
+# Each fitting level stops early once the convergence measurement is below this threshold
+N4ConvergenceThreshold = 0.001
+
+# Number of control points of the B-spline for the bias field in each dimension at the first fitting level
+# The number of control points is doubled at each fitting level. Must be greater than the spline order
+N4ControlPoints = [4, 4, 4]
+
+# Order of the B-spline for the bias field
+N4SplineOrder = 3
+
+# Full width at half maximum of the Gaussian used to deconvolve the intensity histogram
+N4BiasFieldFullWidthAtHalfMaximum = 0.15
+
+# Noise estimate for the Wiener filter used when deconvolving the intensity histogram
+N4WienerFilterNoise = 0.01
+
+# Number of bins of the intensity histogram
+N4HistogramBins = 200
+
+# Method used to calculate the bias field at the original image size
+# ratio - Divide the shrinked image by the corrected shrinked image and zoom the ratio to the original size
+# bspline - Evaluate the B-spline of the N4 log bias field directly at the original size. This is quicker, uses less
+#           memory and does not have artifacts at the first and last slices. Only the control points are cached
+biasFieldMethod = 'bspline'
+
+# Whether to crop the image to the bounding box of the body before N4 bias correction
+# The body is found with Otsu's threshold across all slices and the background outside of the bounding box plus the
+# margin is not corrected
+N4CropToBody = False
+
+# Margin in voxels added to each side of the bounding box of the body when cropping for N4 bias correction
+N4CropMargin = 8
+
+# Whether to perform bias correction in float32 with the division and rescaling done in place
+# This reduces the peak memory of bias correction to about twice the size of the image
+biasCorrectionLowMemory = False
+
+# Whether to measure and print the peak memory of bias correction with tracemalloc
+# Tracing every allocation slows down the stage, so this should only be enabled when measuring
+measureBiasCorrectionMemory = False
+
+# Number of slices to evaluate at once when evaluating the B-spline bias field
+biasFieldChunkSize = 16
+
+# Number of threads used by the N4 ITK bias correction algorithm
+# None will use the global default number of threads for SimpleITK
+# When correcting several images at once, this is the total number of threads split between the images
+N4Threads = None
+
+# Time budget in seconds for the N4 ITK bias correction algorithm
+# If set, the shrink factor and iteration schedule are chosen to fit within the budget, see chooseN4Parameters
+# None will use shrinkFactor and N4Iterations
+N4TimeBudget = None
+
+# Iteration schedules to choose from when using the N4 time budget, listed from most to least accurate
+N4Schedules = [[50, 50, 50, 50], [50, 50, 50], [25, 25, 25], [50, 50], [25, 25]]
+
+# Directory to cache the bias fields from the N4 ITK bias correction algorithm
+# The bias field is reused when the same image is corrected with the same parameters
+# None will store the cache in the biasFieldCache directory of the subject, an empty string disables the cache
+biasFieldCacheDirectory = None
+
+# Maximum total size of the bias field cache in bytes, the least recently used bias fields are removed first
+biasFieldCacheMaxSize = 256 * 1024 * 1024
+
 # Number of clusters for the K-means algorithm for segmenting images
 kMeanClusters = 2
 
+# Method used for the two-class K-means of each slice
+# sklearn - K-means of the pixels of each slice using scikit-learn
+# histogram - Optimal two-class split of the intensity histogram of each slice, this is much quicker
+# histogramVolume - Same as histogram but all slices are clustered at once in one vectorized pass
+# warmStart - K-means of the pixels of each slice starting from the centroids of the previous slice
+kMeansMethod = 'sklearn'
+
+# Maximum number of iterations for K-means when starting from the centroids of the previous slice
+kMeansWarmStartIterations = 20
+
+# K-means is restarted from random centroids when the inertia per pixel is more than this times the previous slice
+kMeansInertiaRatio = 2.0
+
+# K-means is restarted from random centroids when a centroid moves more than this fraction of the distance between the
+# centroids of the previous slice
+kMeansMaxDrift = 0.25
+
+# Number of histogram bins for the histogram K-means methods
+kMeansHistogramBins = 1024
+
+# Seed for the initial centroids of the K-means algorithm
+# A fixed seed makes the segmentation repeatable and the same regardless of the number of segmentation workers
+kMeansRandomState = 0
+
+# Number of worker processes used to segment the slices in parallel
+# None will use the number of CPUs, 1 will segment the slices serially in the current process
+segmentationWorkers = 1
+
+# Number of points of the initial snake, the body outline is resampled to this many points evenly spaced along its arc
+# length. The cost of the snake grows quickly with the number of points
+# None will use the corners of the body outline, so the number of points depends on the shape of the body
+snakePoints = None
+
+# Whether to start the snake of each slice from the snake of the neighbouring slice, scaled to the body outline
+# The slices are segmented outward from the seed slice in both directions
+snakeWarmStart = False
+
+# Slice to start segmenting from when warm starting the snake
+# None will use the middle slice of the abdominal region
+snakeSeedSlice = None
+
+# Engine used to find the region inside the abdominal and thoracic wall from the fat voids of each slice
+# snake - Active contour starting from the body outline that is fit to the edges of the fat voids
+# closing - Closing of the fat voids with a disk followed by filling the holes. This is not iterative and is quicker but
+#           gaps in the wall wider than the disk are not bridged
+boundaryEngine = 'snake'
+
+# Radius in pixels of the disk used to close the fat voids for the closing boundary engine
+boundaryClosingRadius = 10
+
+# Active contour engine used to fit the snake
+# dense - Same algorithm as the scikit-image snake, each iteration multiplies by a dense inverse matrix
+# banded - Solves the cyclic pentadiagonal system of the snake with the FFT and interpolates a precomputed force field
+#          in float32. This is much quicker, but the fitted snake is close to the dense snake rather than identical
+snakeEngine = 'dense'
+
+# Whether to find the body masks, fat void masks and remove small objects for all slices at once rather than slice by
+# slice. The results are the same, only the K-means and boundary of each slice are found slice by slice
+volumeMorphology = False
+
+# Region of interest to segment, the morphology and boundary are only found inside the bounding box of the body plus a
+# margin and slices without any body are skipped
+# None - Segment the whole field of view of every slice
+# slice - Bounding box of the fat of each slice after K-means
+# volume - Bounding box of the fat of all slices
+segmentationROI = None
+
+# Margin in pixels added to each side of the bounding box of the region of interest
+# The body mask is the same as without a region of interest when the margin is greater than the radius of its closing
+segmentationROIMargin = 8
+
+# Number of levels of the resolution pyramid, each level halves the resolution of the slice
+# With more than one level, the K-means centroids are found from a downsampled slice and the snake is fit to the
+# downsampled fat voids before it is refined at full resolution. This is quicker but less accurate, 1 will segment at
+# full resolution only
+pyramidLevels = 1
+
+# Maximum number of iterations to refine the snake at full resolution after fitting it to the downsampled fat voids
+pyramidRefineIterations = 100
+
+# Number of consecutive slices segmented together by one worker
+# Results from one slice, such as the K-means centroids, are only reused for the next slice within the same block, so
+# the results are the same for any number of workers
+segmentationBlockSize = 8
+
 # Threshold area for the fat voids mask in abdominal region. This is used to remove objects smaller than this
 # threshold when determining the fat voids area.
 thresholdAbdominalFatVoidsArea = 30
@@ -0,0 +1,110 @@
+import atexit
+import os
+import queue
+import threading
+
+import nrrd
+import numpy as np
+
+import constants
+
+
+# Writes debug NRRD files on a background thread so that the algorithm does not wait on the disk
+# Arrays are copied when queued since the caller may modify them afterwards. The queue is bounded so that the memory
+# used by queued arrays is limited, when the queue is full the caller waits until a file has been written
+class DebugWriter:
+    encodings = ('raw', 'gzip')
+
+    def __init__(self, maxQueueSize=4, encoding='raw'):
+        if encoding not in self.encodings:
+            raise TypeError('Invalid debug encoding: %s' % encoding)
+
+        self.encoding = encoding
+        self.queue = queue.Queue(maxQueueSize)
+        self.thread = threading.Thread(target=self.run, name='DebugWriter', daemon=True)
+        self.thread.start()
+
+    # Queue an array to be written to filename
+    # If transform is given, it is called on the background thread with the array and the result is written instead
+    def put(self, filename, array, header, transform=None):
+        header = dict(header, encoding=self.encoding)
+
+        self.queue.put((filename, np.array(array), header, transform))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+
+            try:
+                if item is None:
+                    break
+
+                filename, array, header, transform = item
+                if transform:
+                    array = transform(array)
+
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                nrrd.write(filename, array, header)
+            except Exception as e:
+                # Failing to write a debug file should not stop the algorithm
+                print('Unable to write debug file %s: %s' % (item[0], e))
+            finally:
+                self.queue.task_done()
+
+    # Wait until all queued files have been written
+    def flush(self):
+        self.queue.join()
+
+    # Write all queued files and stop the background thread
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+_debugWriter = None
+_debugWriterLock = threading.Lock()
+
+
+# Get the debug writer, which is created the first time a debug file is written
+def getDebugWriter():
+    global _debugWriter
+
+    with _debugWriterLock:
+        if _debugWriter is None:
+            _debugWriter = DebugWriter(constants.debugQueueSize, constants.debugEncoding)
+            atexit.register(_debugWriter.close)
+
+        return _debugWriter
+
+
+# Name of the debug artifact for a filename, this is the filename without the directory or extension
+def getArtifactName(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+# Check whether a debug file should be written
+# enabled is the debug option for the group of files, e.g. constants.debugBiasCorrection. If the group is enabled,
+# the file is written when its artifact name is in constants.debugArtifacts or constants.debugArtifacts is None
+def isDebugEnabled(enabled, filename):
+    return bool(enabled) and (constants.debugArtifacts is None or getArtifactName(filename) in constants.debugArtifacts)
+
+
+# Path of a debug file in the prefix directory within the debug directory of the subject
+def getDebugFilename(prefix, filename):
+    return os.path.join(constants.pathDir, 'debug', prefix, filename)
+
+
+# Queue an array to be written as a debug NRRD file if the debug file is enabled, see isDebugEnabled
+# The file is written in the prefix directory within the debug directory, see getDebugFilename. The path is only built
+# when the file is enabled, so constants.pathDir does not need to be set when debugging is disabled
+def writeDebug(enabled, prefix, filename, array, header, transform=None):
+    if isDebugEnabled(enabled, filename):
+        getDebugWriter().put(getDebugFilename(prefix, filename), array, header, transform)
+
+
+# Wait until all queued debug files have been written
+# Nothing is done if no debug files were written
+def flushDebug():
+    if _debugWriter is not None:
+        _debugWriter.flush()
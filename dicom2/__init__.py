@@ -1,10 +1,15 @@
-from dicom2.loadDirectory import loadDirectory
+from dicom2.loadDirectory import loadDirectory, organizeDatasets
+from dicom2.dicomIndex import DICOMIndex
 from dicom2.patient import Patient
 from dicom2.study import Study
 from dicom2.series import Series
+from dicom2.sliceRecord import SliceRecord
 from dicom2.combineSlices import combineSlices
 from dicom2.sortSlices import sortSlices
+from dicom2.convertToNrrd import convertToNrrd
+from dicom2.cohort import Catalogue, indexCohort
 
 from dicom2.util import *
 
-__all__ = ['loadDirectory', 'patient', 'study', 'series', 'util', 'combineSlices', 'sortSlices']
+__all__ = ['loadDirectory', 'organizeDatasets', 'DICOMIndex', 'patient', 'study', 'series', 'SliceRecord', 'util',
+           'combineSlices', 'sortSlices', 'convertToNrrd', 'Catalogue', 'indexCohort']
@@ -0,0 +1,165 @@
+import sqlite3
+
+from dicom2.loadDirectory import organizeDatasets
+from dicom2.patients import Patients
+from dicom2.util import *
+
+
+class Catalogue:
+    """
+    Catalogue of the series for each subject in a cohort.
+
+    Each row of the catalogue is a dictionary describing one series: the subject, patient, study and series along with
+    the number of slices and the dimensions of the slices. The catalogue can be queried in memory or saved to and loaded
+    from a SQLite database. When created by indexCohort, the organized Patients for each subject are kept in subjects.
+    """
+
+    columns = ['subject', 'PatientID', 'StudyInstanceUID', 'StudyDate', 'StudyDescription', 'SeriesInstanceUID',
+               'SeriesDescription', 'SeriesNumber', 'sliceCount', 'Rows', 'Columns']
+
+    def __init__(self, rows=None, subjects=None):
+        self.rows = rows or []
+        self.subjects = subjects or {}
+
+    @classmethod
+    def fromSubjects(cls, subjects):
+        """
+        Creates a catalogue from the organized Patients for each subject.
+
+        :param subjects: Dictionary with the subject name as the key and Patients as the value
+        :return: Returns the catalogue
+        """
+        # The study date is stored as its DICOM string since it is a pydicom object when datetime conversion is enabled
+        rows = []
+        for subject, patients in sorted(subjects.items()):
+            for patient in patients.values():
+                for study in patient.values():
+                    for series in study.values():
+                        rows.append({
+                            'subject': subject,
+                            'PatientID': patient.ID,
+                            'StudyInstanceUID': study.ID,
+                            'StudyDate': None if study.Date is None else str(study.Date),
+                            'StudyDescription': study.Description,
+                            'SeriesInstanceUID': series.ID,
+                            'SeriesDescription': series.Description,
+                            'SeriesNumber': None if series.Number is None else int(series.Number),
+                            'sliceCount': len(series),
+                            'Rows': series[0].get('Rows') if series else None,
+                            'Columns': series[0].get('Columns') if series else None,
+                        })
+
+        return cls(rows, subjects)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads a catalogue that was saved to a SQLite database.
+
+        :param filename: Filename of the SQLite database
+        :return: Returns the catalogue
+        """
+        connection = sqlite3.connect(filename)
+        try:
+            cursor = connection.execute('SELECT %s FROM series' % ', '.join(cls.columns))
+            rows = [dict(zip(cls.columns, row)) for row in cursor]
+        finally:
+            connection.close()
+
+        return cls(rows)
+
+    def save(self, filename):
+        """
+        Saves the catalogue to a SQLite database. Any existing catalogue in the database is replaced.
+
+        :param filename: Filename of the SQLite database
+        """
+        connection = sqlite3.connect(filename)
+        try:
+            connection.execute('DROP TABLE IF EXISTS series')
+            connection.execute('CREATE TABLE series (%s)' % ', '.join(self.columns))
+            connection.executemany('INSERT INTO series VALUES (%s)' % ', '.join('?' * len(self.columns)),
+                                   ([row[column] for column in self.columns] for row in self.rows))
+            connection.commit()
+        finally:
+            connection.close()
+
+    def query(self, **filters):
+        """
+        Retrieves the rows of the catalogue that match the filters.
+
+        Each filter is a column name and a condition. The condition can be a value, a list of values or a callable, see
+        matchesFilters. For example, query(SeriesDescription=lambda x: x.startswith('t1_'), SeriesNumber=[1, 2])
+
+        :return: Returns a list of rows that match all of the filters
+        """
+        return [row for row in self.rows if matchesFilters(row, filters)]
+
+    def subjectNames(self):
+        return sorted(set(row['subject'] for row in self.rows))
+
+
+def _indexShard(shard):
+    """
+    Reads the headers for a shard of DICOM files and organizes them by patient, study and series.
+
+    :param shard: Tuple of the subject name and list of DICOM filenames
+    :return: Returns a tuple of the subject name and Patients
+    """
+    subject, filenames = shard
+
+    return subject, organizeDatasets(readDatasets(filenames, headerOnly=True), compact=True)
+
+
+def findSubjects(root, scansDirectory='SCANS'):
+    """
+    Finds the subject directories in a cohort. A subject directory is any directory directly within the root directory
+    that contains the scans directory, e.g. <root>/<subject>/SCANS
+
+    :param root: Root directory of the cohort
+    :param scansDirectory: Name of the directory containing the DICOM files within each subject directory
+    :return: Returns a dictionary with the subject name as the key and the scans directory as the value
+    """
+    subjects = {}
+    for subject in sorted(os.listdir(root)):
+        path = os.path.join(root, subject, scansDirectory)
+
+        if os.path.isdir(path):
+            subjects[subject] = path
+
+    return subjects
+
+
+def indexCohort(root, catalogueFilename=None, workers=None, shardSize=256, scansDirectory='SCANS'):
+    """
+    Indexes all of the subjects within a cohort directory.
+
+    The DICOM files of each subject are split into shards of shardSize files and the shards are read on a process pool.
+    Each worker reads only the headers and organizes the images by patient, study and series with compact slice
+    records. The results for each subject are merged together and a catalogue of the series is created.
+
+    :param root: Root directory of the cohort, see findSubjects
+    :param catalogueFilename: If specified, the catalogue is saved to a SQLite database at this filename
+    :param workers: Number of processes to use. If None, the number of processes is based on the number of CPUs
+    :param shardSize: Number of DICOM files to read in each task
+    :param scansDirectory: Name of the directory containing the DICOM files within each subject directory
+    :return: Returns the catalogue of the cohort
+    """
+    shards = []
+    for subject, path in findSubjects(root, scansDirectory).items():
+        filenames = findDICOMFiles(path)
+
+        for i in range(0, len(filenames), shardSize):
+            shards.append((subject, filenames[i:i + shardSize]))
+
+    subjects = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for subject, patients in executor.map(_indexShard, shards):
+            subjects.setdefault(subject, Patients()).merge(patients)
+
+    catalogue = Catalogue.fromSubjects(subjects)
+
+    if catalogueFilename:
+        catalogue.save(catalogueFilename)
+
+    return catalogue
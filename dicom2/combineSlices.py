@@ -1,32 +1,91 @@
+import concurrent.futures
+
 from dicom2.sortSlices import *
 
 pydicom.config.datetime_conversion = True
 
 
-def combineSlices(datasets, method=MethodType.Unknown, reverse=False):
+def combineSlices(datasets, method=MethodType.Unknown, reverse=False, workers=1, rescale=False, memmapFilename=None):
     """
     Combines the given dataset for Volume into a 3D volume. In addition, some parameters for the volume are
     calculated, such as:
         Origin, spacing, coordinate system, and orientation.
+
+    The volume is allocated once and each slice is decoded directly into its position along the Z axis. The volume is
+    stored in Fortran order so that each slice is contiguous in memory.
+
+    :param datasets: List of DICOM datasets or slice records to combine
+    :param method: Method to use for sorting the slices, if Unknown then the best method is selected
+    :param reverse: Whether to reverse the order of the slices
+    :param workers: Number of threads to decode the slices with. If 1, the slices are decoded serially. If None, the
+                    number of threads is chosen based on the number of CPUs
+    :param rescale: Whether to apply RescaleSlope and RescaleIntercept to the pixel values. If true, the volume is
+                    returned as float32
+    :param memmapFilename: If specified, the volume is written to a memory-mapped .npy file with this filename rather
+                           than being stored in memory
     """
 
     type_ = VolumeType.Unknown
 
+    # Extract the tags used for sorting from the datasets once
+    table = SliceTable(datasets)
+
     if method is MethodType.Unknown:
-        method, type_ = getBestMethod(datasets)
-    elif not isMethodAvailable(datasets, method):
+        method, type_ = getBestMethod(table)
+    elif not table.isMethodAvailable(method):
         raise TypeError('Invalid method specified')
 
-    sortedDataset, zSpacing, sliceCosines = sortSlices(datasets, method, reverse)
+    sortedDataset, zSpacing, sliceCosines = sortSlices(datasets, method, reverse, table)
 
     # Get 3D volume from list of datasets
-    volume = np.dstack((x.pixel_array for x in sortedDataset))
+    # If the datasets were loaded with only the header, the pixel data is read from the file here
+    # The first slice is decoded to determine the shape and data type of the volume
+    # Every other slice must have the same shape and data type so that it is not silently cast or broadcast
+    firstSlice = readPixelArray(sortedDataset[0])
+    sliceShape, sliceDtype = firstSlice.shape, firstSlice.dtype
+    shape = sliceShape + (len(sortedDataset),)
+    dtype = np.float32 if rescale else sliceDtype
+
+    if memmapFilename:
+        volume = np.lib.format.open_memmap(memmapFilename, mode='w+', dtype=dtype, shape=shape, fortran_order=True)
+    else:
+        volume = np.empty(shape, dtype=dtype, order='F')
+
+    def decodeSlice(index, pixelArray=None):
+        dataset = sortedDataset[index]
+        if pixelArray is None:
+            pixelArray = readPixelArray(dataset)
+
+        if pixelArray.shape != sliceShape or pixelArray.dtype != sliceDtype:
+            raise TypeError('All slices must have the same shape and data type')
+
+        volume[:, :, index] = pixelArray
+
+        if rescale:
+            # Apply the rescale slope and intercept in place, this converts the stored values to output units
+            volume[:, :, index] *= float(dataset.get('RescaleSlope', 1.0))
+            volume[:, :, index] += float(dataset.get('RescaleIntercept', 0.0))
+
+    decodeSlice(0, firstSlice)
+    del firstSlice
+
+    if workers == 1:
+        for index in range(1, len(sortedDataset)):
+            decodeSlice(index)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            # Retrieve the results so that any exceptions are raised
+            list(executor.map(decodeSlice, range(1, len(sortedDataset))))
+
+    if memmapFilename:
+        volume.flush()
 
     space = 'left-posterior-superior'
     # Append the Z cosines to image orientation and then resize into 3x3 matrix
     orientation = np.reshape(list(datasets[0].ImageOrientationPatient) + sliceCosines, (3, 3)).T
     # Concatenate (x,y) spacing list and zSpacing list
     spacing = list(datasets[0].PixelSpacing) + list([zSpacing])
-    origin = datasets[0].ImagePositionPatient
+    # Origin is the position of the first slice in the volume
+    origin = sortedDataset[0].ImagePositionPatient
 
     return method, type_, space, orientation, spacing, origin, volume
@@ -0,0 +1,105 @@
+import zlib
+
+from dicom2.sortSlices import *
+
+pydicom.config.datetime_conversion = True
+
+# Names of the NRRD types for each NumPy data type
+nrrdTypes = {
+    'int8': 'int8',
+    'uint8': 'uint8',
+    'int16': 'int16',
+    'uint16': 'uint16',
+    'int32': 'int32',
+    'uint32': 'uint32',
+    'int64': 'int64',
+    'uint64': 'uint64',
+    'float32': 'float',
+    'float64': 'double',
+}
+
+
+def convertToNrrd(datasets, filename, method=MethodType.Unknown, reverse=False, encoding='raw', compressionLevel=9):
+    """
+    Converts the given dataset for Volume into a NRRD file without combining the slices into a volume in memory.
+
+    The NRRD header is calculated from the sorted datasets and then each slice is decoded and appended to the data
+    section of the file one at a time. Only one slice is held in memory at a time regardless of the number of slices.
+    Reading the resulting file with nrrd.read gives the same volume and header fields as combineSlices, although the
+    bytes of the file itself may differ from writing that volume with nrrd.write.
+
+    :param datasets: List of DICOM datasets or slice records to convert
+    :param filename: Filename of the NRRD file to write
+    :param method: Method to use for sorting the slices, if Unknown then the best method is selected
+    :param reverse: Whether to reverse the order of the slices
+    :param encoding: Encoding of the data section, either raw or gzip
+    :param compressionLevel: Compression level from 1-9 when using gzip encoding
+    :return: Returns the NRRD header as a dictionary
+    """
+    if encoding not in ('raw', 'gzip'):
+        raise TypeError('Invalid encoding specified, must be raw or gzip')
+
+    if compressionLevel not in range(1, 10):
+        raise TypeError('Invalid compression level specified, must be from 1-9')
+
+    sortedDataset, zSpacing, sliceCosines = sortSlices(datasets, method, reverse)
+
+    # The first slice is decoded to determine the shape and data type of the volume
+    pixelArray = readPixelArray(sortedDataset[0])
+    shape = pixelArray.shape
+    dtype = pixelArray.dtype
+
+    if dtype.name not in nrrdTypes:
+        raise TypeError('Unsupported data type for NRRD file: %s' % dtype.name)
+
+    spacing = list(sortedDataset[0].PixelSpacing) + list([zSpacing])
+    origin = sortedDataset[0].ImagePositionPatient
+
+    header = {
+        'type': nrrdTypes[dtype.name],
+        'dimension': 3,
+        'space': 'left-posterior-superior',
+        'sizes': list(shape) + [len(sortedDataset)],
+        'space directions': (np.identity(3) * np.array(spacing)).tolist(),
+        'endian': 'little',
+        'encoding': encoding,
+        'space origin': [float(x) for x in origin],
+    }
+
+    with open(filename, 'wb') as fh:
+        fh.write(b'NRRD0004\n')
+        fh.write(b'# Complete NRRD file format specification at:\n')
+        fh.write(b'# http://teem.sourceforge.net/nrrd/format.html\n')
+        fh.write(('type: %s\n' % header['type']).encode('ascii'))
+        fh.write(('dimension: %i\n' % header['dimension']).encode('ascii'))
+        fh.write(('space: %s\n' % header['space']).encode('ascii'))
+        fh.write(('sizes: %s\n' % ' '.join(str(x) for x in header['sizes'])).encode('ascii'))
+        fh.write(('space directions: %s\n' % ' '.join(_formatVector(x) for x in header['space directions']))
+                 .encode('ascii'))
+        fh.write(('endian: %s\n' % header['endian']).encode('ascii'))
+        fh.write(('encoding: %s\n' % header['encoding']).encode('ascii'))
+        fh.write(('space origin: %s\n' % _formatVector(header['space origin'])).encode('ascii'))
+        fh.write(b'\n')
+
+        compressor = zlib.compressobj(compressionLevel, zlib.DEFLATED, zlib.MAX_WBITS | 16) \
+            if encoding == 'gzip' else None
+
+        for index, dataset in enumerate(sortedDataset):
+            if index > 0:
+                pixelArray = readPixelArray(dataset)
+
+            if pixelArray.shape != shape or pixelArray.dtype != dtype:
+                raise TypeError('All slices must have the same shape and data type')
+
+            # Volume is written in Fortran order, so the rows of the slice are the fastest axis
+            data = pixelArray.astype(dtype.newbyteorder('<'), copy=False).tobytes(order='F')
+            fh.write(compressor.compress(data) if compressor else data)
+
+        if compressor:
+            fh.write(compressor.flush())
+
+    return header
+
+
+def _formatVector(vector):
+    return '(%s)' % ','.join(repr(float(x)) for x in vector)
@@ -0,0 +1,146 @@
+import json
+import sqlite3
+
+from pydicom.dataset import Dataset
+
+from dicom2.util import *
+
+
+class DICOMIndex:
+    """
+    Persistent index of DICOM headers stored in a SQLite database.
+
+    Each DICOM file is keyed by its absolute filename, size and modification time. The header tags from headerTags are
+    stored for each file so the Patient/Study/Series hierarchy can be rebuilt without reading the DICOM files again.
+    When a directory is updated, only new or changed files are read and files that no longer exist are removed.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files ('
+                                'filename TEXT PRIMARY KEY, '
+                                'size INTEGER NOT NULL, '
+                                'mtime REAL NOT NULL, '
+                                'PatientID TEXT, '
+                                'StudyInstanceUID TEXT, '
+                                'SeriesInstanceUID TEXT, '
+                                'SeriesDescription TEXT, '
+                                'SeriesNumber INTEGER, '
+                                'header TEXT NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS filesSeries ON files '
+                                '(PatientID, StudyInstanceUID, SeriesInstanceUID)')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _entries(self, path):
+        """
+        Retrieves the filename, size and modification time for each indexed file within a directory.
+
+        :param path: Directory to retrieve the entries for
+        :return: Returns a dictionary with filename as the key and (size, mtime) as the value
+        """
+        prefix = os.path.join(os.path.abspath(path), '')
+        cursor = self.connection.execute('SELECT filename, size, mtime FROM files WHERE substr(filename, 1, ?) = ?',
+                                         (len(prefix), prefix))
+
+        return {filename: (size, mtime) for filename, size, mtime in cursor}
+
+    def update(self, path, workers=1, useProcesses=False):
+        """
+        Updates the index for a directory. Files that are new or have a different size or modification time than the
+        indexed entry are read and stored. Entries for files that no longer exist in the directory are removed.
+
+        :param path: Directory to search for DICOM files
+        :param workers: Number of workers to read the files with, see readDatasets
+        :param useProcesses: Whether to use a process pool instead of a thread pool to read the files
+        :return: Returns a tuple of the number of files read and the number of entries removed
+        """
+        entries = self._entries(path)
+
+        changedFilenames = []
+        changedStats = []
+        for filename in findDICOMFiles(os.path.abspath(path)):
+            stat = os.stat(filename)
+            entry = entries.pop(filename, None)
+
+            if entry is None or entry != (stat.st_size, stat.st_mtime):
+                changedFilenames.append(filename)
+                changedStats.append(stat)
+
+        # Any entries left over were not found in the directory, so remove them
+        self.connection.executemany('DELETE FROM files WHERE filename = ?', ((filename,) for filename in entries))
+
+        # Read the headers for new or changed files and store them
+        DCMImages = readDatasets(changedFilenames, headerOnly=True, workers=workers, useProcesses=useProcesses)
+        # With datetime conversion enabled, the date and time values are pydicom objects that are stored as their DICOM
+        # string, which is converted back when the header is decoded
+        rows = []
+        for filename, stat, DCMImage in zip(changedFilenames, changedStats, DCMImages):
+            seriesNumber = DCMImage.get('SeriesNumber')
+
+            rows.append((filename, stat.st_size, stat.st_mtime, DCMImage.get('PatientID'),
+                         DCMImage.get('StudyInstanceUID'), DCMImage.get('SeriesInstanceUID'),
+                         DCMImage.get('SeriesDescription'), int(seriesNumber) if seriesNumber is not None else None,
+                         json.dumps(DCMImage.to_json_dict(), default=str)))
+
+        self.connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.connection.commit()
+
+        return len(changedFilenames), len(entries)
+
+    def datasets(self, path=None, filters=None):
+        """
+        Retrieves the header-only DICOM datasets from the index. The filename of each dataset is set so that the pixel
+        data can be read with readPixelArray.
+
+        :param path: If specified, only datasets within this directory are returned
+        :param filters: Dictionary of DICOM keyword and condition that the images must match, see matchesFilters.
+                        Filters on the indexed columns are checked before the stored header is decoded. Only the
+                        keywords in headerTags are stored in the index, so a TypeError is raised for any other keyword
+        :return: Returns a list of DICOM datasets sorted by filename
+        """
+        # A filter on a keyword that is not stored would never match, so it is an error rather than returning nothing
+        for keyword in filters or {}:
+            if keyword not in headerTags:
+                raise TypeError('Unable to filter on %s, only the keywords in headerTags are stored in the index'
+                                % keyword)
+
+        columns = ['PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'SeriesDescription', 'SeriesNumber']
+        query = 'SELECT filename, header, %s FROM files' % ', '.join(columns)
+
+        if path is None:
+            cursor = self.connection.execute(query + ' ORDER BY filename')
+        else:
+            prefix = os.path.join(os.path.abspath(path), '')
+            cursor = self.connection.execute(query + ' WHERE substr(filename, 1, ?) = ? ORDER BY filename',
+                                             (len(prefix), prefix))
+
+        # Split the filters into ones that can be checked with the indexed columns and ones that need the header
+        filters = filters or {}
+        columnFilters = {keyword: condition for keyword, condition in filters.items() if keyword in columns}
+        headerFilters = {keyword: condition for keyword, condition in filters.items() if keyword not in columns}
+
+        DCMImages = []
+        for filename, header, *values in cursor:
+            if columnFilters and not matchesFilters(dict(zip(columns, values)), columnFilters):
+                continue
+
+            DCMImage = Dataset.from_json(header)
+            DCMImage.filename = filename
+
+            if headerFilters and not matchesFilters(DCMImage, headerFilters):
+                continue
+
+            DCMImages.append(DCMImage)
+
+        return DCMImages
@@ -1,77 +1,120 @@
-import os
+from dicom2.dicomIndex import DICOMIndex
+from dicom2.patients import Patients
+from dicom2.sliceRecord import SliceRecord
+from dicom2.util import *
 
-import pydicom
-import pydicom.filereader
 
-from dicom2.patient import Patient
-from dicom2.patients import Patients
-from dicom2.series import Series
-from dicom2.study import Study
+def loadDirectory(path, patientID=None, studyID=None, seriesID=None, headerOnly=False, workers=1,
+                  useProcesses=False, indexFilename=None, compact=False, seriesDescription=None, seriesNumber=None,
+                  modality=None, filters=None):
+    """
+    Loads all DICOM files within a directory and organizes them by patient, study and series.
+
+    When headerOnly is true, only the tags needed to organize and sort the images are read and the pixel data is
+    skipped. The pixel data is read from disk later when the slices are combined into a volume. Reading only the
+    header is considerably quicker for large directories and uses less memory.
+
+    :param path: Directory to search for DICOM files
+    :param patientID: If specified, only images with this patient ID are loaded and the patient is returned
+    :param studyID: If specified, only images with this study instance UID are loaded and the study is returned
+    :param seriesID: If specified, only images with this series instance UID are loaded and the series is returned
+    :param headerOnly: Whether to only read the header tags necessary for organizing and sorting the images
+    :param workers: Number of workers to read the files with, see readDatasets
+    :param useProcesses: Whether to use a process pool instead of a thread pool to read the files
+    :param indexFilename: If specified, the headers are stored in a persistent index at this filename and only new or
+                          changed files are read from the directory. The images are always loaded with only the header
+                          when using an index, see DICOMIndex. Only the keywords in headerTags are stored in the
+                          index, so the filters can only use those keywords and a TypeError is raised otherwise
+    :param compact: Whether to store a compact SliceRecord for each image in the series instead of the DICOM dataset
+    :param seriesDescription: If specified, only images with a matching series description are loaded
+    :param seriesNumber: If specified, only images with a matching series number are loaded
+    :param modality: If specified, only images with a matching modality are loaded
+    :param filters: Dictionary of additional DICOM keyword and condition that the images must match
+    :return: Returns Patients, Patient, Study or Series depending on the IDs given
+
+    The IDs, seriesDescription, seriesNumber, modality and the conditions in filters can each be a value that must be
+    equal, a list of values or a callable that returns true for matching values, see matchesFilters. The filters are
+    checked after reading only the tags needed for them, so the rest of the file is never read for rejected images.
+    """
+    # Combine all of the filters into one dictionary so they are checked when reading the files
+    filters = dict(filters or {})
+    for keyword, condition in [('PatientID', patientID), ('StudyInstanceUID', studyID),
+                               ('SeriesInstanceUID', seriesID), ('SeriesDescription', seriesDescription),
+                               ('SeriesNumber', seriesNumber), ('Modality', modality)]:
+        if condition is not None:
+            filters[keyword] = condition
+
+    if indexFilename:
+        # Update the index with any new or changed files and retrieve the headers from the index
+        with DICOMIndex(indexFilename) as index:
+            index.update(path, workers=workers, useProcesses=useProcesses)
+            DCMImages = index.datasets(path, filters)
+    else:
+        # Search for DICOM files within directory
+        DCMFilenames = findDICOMFiles(path)
 
+        # Read each DICOM file
+        DCMImages = readDatasets(DCMFilenames, headerOnly=headerOnly, workers=workers, useProcesses=useProcesses,
+                                 filters=filters)
 
-def loadDirectory(path, patientID=None, studyID=None, seriesID=None):
+        # Remove images that did not match the filters
+        DCMImages = [DCMImage for DCMImage in DCMImages if DCMImage is not None]
+
+    return organizeDatasets(DCMImages, patientID, studyID, seriesID, compact)
+
+
+def organizeDatasets(DCMImages, patientID=None, studyID=None, seriesID=None, compact=False):
+    """
+    Organizes the DICOM images by patient, study and series.
+
+    :param DCMImages: List of DICOM datasets to organize
+    :param patientID: If specified, only images with this patient ID are kept and the patient is returned
+    :param studyID: If specified, only images with this study instance UID are kept and the study is returned
+    :param seriesID: If specified, only images with this series instance UID are kept and the series is returned
+    :param compact: Whether to store a compact SliceRecord for each image in the series instead of the DICOM dataset
+    :return: Returns Patients, Patient, Study or Series depending on the IDs given
+
+    Each ID can be a value, a list of values or a callable, see matchesFilters. If an ID matches more than one patient,
+    study or series, the first one found is returned. None is returned if no images match.
+    """
+    filters = {keyword: condition for keyword, condition in [('PatientID', patientID), ('StudyInstanceUID', studyID),
+                                                            ('SeriesInstanceUID', seriesID)] if condition}
     patients = Patients()
-    patient = None
-    study = None
-    series = None
-
-    # Search for DICOM files within directory
-    # Append each DICOM file to a list
-    DCMFilenames = []
-    for dirName, subdirs, filenames in os.walk(path):
-        for filename in filenames:
-            if filename.endswith('.dcm'):
-                DCMFilenames.append(os.path.join(dirName, filename))
-
-    # Loop through each DICOM filename
-    for filename in DCMFilenames:
-        # Read DICOM file
-        DCMImage = pydicom.read_file(filename)
-
-        if patientID:
-            if DCMImage.PatientID != patientID:
-                continue
-
-            patient = Patient(DCMImage)
-        else:
-            # Check for existing patient, if not add new patient
-            if DCMImage.PatientID in patients:
-                patient = patients[DCMImage.PatientID]
-            else:
-                patient = patients.add(DCMImage)
 
-        if studyID:
-            if DCMImage.StudyInstanceUID != studyID:
-                continue
+    # Loop through each DICOM image
+    for DCMImage in DCMImages:
+        if filters and not matchesFilters(DCMImage, filters):
+            continue
 
-            study = Study(DCMImage)
+        # Check for existing patient, if not add new patient
+        if DCMImage.PatientID in patients:
+            patient = patients[DCMImage.PatientID]
         else:
-            # Check for existing study for patient, if not add a new study
-            if DCMImage.StudyInstanceUID in patient:
-                study = patient[DCMImage.StudyInstanceUID]
-            else:
-                study = patient.add(DCMImage)
+            patient = patients.add(DCMImage)
 
-        if seriesID:
-            if DCMImage.SeriesInstanceUID != seriesID:
-                continue
+        # Check for existing study for patient, if not add a new study
+        if DCMImage.StudyInstanceUID in patient:
+            study = patient[DCMImage.StudyInstanceUID]
+        else:
+            study = patient.add(DCMImage)
 
-            series = Series(DCMImage)
+        # Check for existing series within study, if not add a new series
+        if DCMImage.SeriesInstanceUID in study:
+            series = study[DCMImage.SeriesInstanceUID]
         else:
-            # Check for existing series within study, if not add a new series
-            if DCMImage.SeriesInstanceUID in study:
-                series = study[DCMImage.SeriesInstanceUID]
-            else:
-                series = study.add(DCMImage)
+            series = study.add(DCMImage)
 
         # Append image to series
-        series.append(DCMImage)
+        # For compact series, only the tags needed for sorting and combining the slices are kept
+        series.append(SliceRecord(DCMImage) if compact else DCMImage)
 
+    # The IDs given choose whether the patient, study or series is returned
     if patientID:
-        return patient
+        return next(iter(patients.values()), None)
     elif studyID:
-        return study
+        return next((study for patient in patients.values() for study in patient.values()), None)
     elif seriesID:
-        return series
+        return next((series for patient in patients.values() for study in patient.values()
+                     for series in study.values()), None)
     else:
         return patients
@@ -57,6 +57,18 @@ class Patient(dict):
 
         return None
 
+    def merge(self, other):
+        """
+        Merges the studies from another patient into this patient. Studies that exist in both patients are merged.
+
+        :param other: Patient to merge into this patient
+        """
+        for ID, study in other.items():
+            if ID in self:
+                self[ID].merge(study)
+            else:
+                self[ID] = study
+
     def only(self):
         if len(self) != 1:
             raise TypeError('More than one study is available')
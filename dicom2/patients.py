@@ -15,6 +15,18 @@ class Patients(dict):
         else:
             raise TypeError("Can only add patient or DICOM image to Patients dictionary")
 
+    def merge(self, other):
+        """
+        Merges the patients from another Patients dictionary into this one. Patients that exist in both are merged.
+
+        :param other: Patients dictionary to merge into this one
+        """
+        for ID, patient in other.items():
+            if ID in self:
+                self[ID].merge(patient)
+            else:
+                self[ID] = patient
+
     def only(self):
         if len(self) != 1:
             raise TypeError('More than one patient is available')
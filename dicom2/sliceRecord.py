@@ -0,0 +1,56 @@
+import pydicom
+
+
+class SliceRecord:
+    """
+    Compact record of a DICOM image that contains only the filename and the tags needed to sort and combine slices.
+
+    A SliceRecord can be used in place of a pydicom Dataset within a Series. The tags are accessed as attributes and
+    membership can be checked with the in operator, e.g. 'SliceLocation' in record. Tags that are not present in the
+    DICOM image are set to None. The pixel data is not stored and is read from the file when requested.
+    """
+
+    __slots__ = ('filename', 'SliceLocation', 'ImagePositionPatient', 'ImageOrientationPatient', 'TriggerTime',
+                 'AcquisitionDateTime', 'AcquisitionTime', 'ImageNumber', 'PixelSpacing', 'Rows', 'Columns',
+                 'RescaleSlope', 'RescaleIntercept')
+
+    def __init__(self, DCMImage=None):
+        if DCMImage:
+            self.filename = DCMImage.filename
+            self.SliceLocation = _toFloat(DCMImage.get('SliceLocation'))
+            self.ImagePositionPatient = _toTuple(DCMImage.get('ImagePositionPatient'))
+            self.ImageOrientationPatient = _toTuple(DCMImage.get('ImageOrientationPatient'))
+            self.TriggerTime = _toFloat(DCMImage.get('TriggerTime'))
+            self.AcquisitionDateTime = DCMImage.get('AcquisitionDateTime')
+            self.AcquisitionTime = DCMImage.get('AcquisitionTime')
+            self.ImageNumber = DCMImage.get('ImageNumber')
+            self.PixelSpacing = _toTuple(DCMImage.get('PixelSpacing'))
+            self.Rows = DCMImage.get('Rows')
+            self.Columns = DCMImage.get('Columns')
+            self.RescaleSlope = _toFloat(DCMImage.get('RescaleSlope'))
+            self.RescaleIntercept = _toFloat(DCMImage.get('RescaleIntercept'))
+        else:
+            for name in self.__slots__:
+                setattr(self, name, None)
+
+    def __contains__(self, keyword):
+        return keyword in self.__slots__ and getattr(self, keyword) is not None
+
+    def __repr__(self):
+        return 'SliceRecord(%r)' % self.filename
+
+    def get(self, keyword, default=None):
+        value = getattr(self, keyword, None)
+        return default if value is None else value
+
+    @property
+    def pixel_array(self):
+        return pydicom.dcmread(self.filename).pixel_array
+
+
+def _toFloat(value):
+    return None if value is None else float(value)
+
+
+def _toTuple(value):
+    return None if value is None else tuple(float(x) for x in value)
@@ -1,6 +1,5 @@
 import numpy as np
 import pydicom
-import operator
 from dicom2.util import *
 import logging
 
@@ -8,62 +7,52 @@ logger = logging.getLogger(__name__)
 pydicom.config.datetime_conversion = True
 
 
-def sortSlices(datasets, method=MethodType.Unknown, reverse=False):
+def sortSlices(datasets, method=MethodType.Unknown, reverse=False, table=None):
     """
     Sorts the given dataset based on the parameters.
+
+    If a SliceTable for the datasets has already been created, it can be given to prevent extracting the tags again.
     """
     if len(datasets) == 0:
         raise TypeError('Must have at least one image in series to sort slices')
 
     type_ = VolumeType.Unknown
 
+    # Extract the tags used for sorting from the datasets once
+    if table is None:
+        table = SliceTable(datasets)
+
     if method is MethodType.Unknown:
-        method, type_ = getBestMethod(datasets)
-    elif not isMethodAvailable(datasets, method):
+        method, type_ = getBestMethod(table)
+    elif not table.isMethodAvailable(method):
         raise TypeError('Invalid method specified')
 
-    # Get slice positions for each object
-    sliceCosines, slicePositions = slicePositionsFromPatientInfo(datasets)
-
-    if method == MethodType.SliceLocation:
-        sortedDataset = sorted(datasets, key=lambda x: x.SliceLocation, reverse=reverse)
-
-        spacingPerSlice = np.diff([d.SliceLocation for d in sortedDataset])
-        zSpacing = np.mean(spacingPerSlice)
-    elif method == MethodType.PatientLocation:
-        # Put slice positions and datasets together and sort by slice position
-        sortedTogether = sorted(zip(slicePositions, datasets), key=operator.itemgetter(0), reverse=reverse)
-
-        # Split the sorted slice positions and datasets into two separate lists
-        sortedSlicePositions, sortedDataset = list(zip(*sortedTogether))
+    # Get slice cosines, the slice positions are only calculated if sorting by patient location
+    sliceCosines = table.sliceCosines().tolist()
 
-        spacingPerSlice = np.diff(sortedSlicePositions)
-        zSpacing = np.mean(spacingPerSlice)
-    elif method == MethodType.TriggerTime:
-        sortedDataset = sorted(datasets, key=lambda x: x.TriggerTime, reverse=reverse)
+    # Sort the datasets based on the values for the method
+    order, sortedValues = table.sortOrder(method, reverse)
+    sortedDataset = [datasets[i] for i in order]
 
-        spacingPerSlice = np.diff([d.TriggerTime for d in sortedDataset])
-        zSpacing = np.mean(spacingPerSlice)
-    elif method == MethodType.AcquisitionDateTime:
-        sortedDataset = sorted(datasets, key=lambda x: x.AcquisitionDateTime, reverse=reverse)
-
-        # AcquisitionDateTime is in seconds, convert to milliseconds
-        spacingPerSlice = np.diff([d.AcquisitionDateTime.timestamp() for d in sortedDataset]) * 1000.0
-        zSpacing = np.mean(spacingPerSlice)
-    elif method == MethodType.ImageNumber:
+    if method == MethodType.ImageNumber:
         spacingPerSlice = [0, 1, 2]
-        sortedDataset = sorted(datasets, key=lambda x: x.ImageNumber, reverse=reverse)
         # ImageNumber has unknown z spacing, no units
         zSpacing = 0.0
     else:
-        raise TypeError('Invalid method')
+        spacingPerSlice = np.diff(sortedValues)
+
+        # AcquisitionDateTime is in seconds, convert to milliseconds
+        if method == MethodType.AcquisitionDateTime:
+            spacingPerSlice *= 1000.0
+
+        zSpacing = np.mean(spacingPerSlice)
 
     # Check for oddities in the spacing per slice
     # Any spacing that deviate by a large amount or are close to zero indicate something is wrong
     if not np.allclose(spacingPerSlice, spacingPerSlice[0], atol=0.0, rtol=0.1):
         logger.warning('Warning: Spacing per slice is not uniform, greater than 10% tolerance')
         logger.debug('Spacing per slice: %s' % spacingPerSlice)
-    if any(np.isclose(spacingPerSlice, [0.0], atol=0.01 * float(zSpacing))):
+    if np.any(np.isclose(spacingPerSlice, [0.0], atol=0.01 * float(zSpacing))):
         logger.warning('Warning: Two slices are within 1% difference of each other')
         logger.debug('Spacing per slice: %s' % spacingPerSlice)
 
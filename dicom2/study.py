@@ -35,6 +35,19 @@ class Study(dict):
 
         return None
 
+    def merge(self, other):
+        """
+        Merges the series from another study into this study. Images from series that exist in both studies are
+        appended to the existing series.
+
+        :param other: Study to merge into this study
+        """
+        for ID, series in other.items():
+            if ID in self:
+                self[ID].extend(series)
+            else:
+                self[ID] = series
+
     def only(self):
         if len(self) != 1:
             raise TypeError('More than one patient is available')
@@ -1,5 +1,11 @@
+import concurrent.futures
+import functools
+import os
 from enum import Enum
+
 import numpy as np
+import pydicom
+import pydicom.datadict
 
 
 class VolumeType(Enum):
@@ -17,28 +23,297 @@ class MethodType(Enum):
     ImageNumber = 5
 
 
+# DICOM tags that are read when only the header of a DICOM file is loaded
+# This contains the tags used to organize the images into Patient/Study/Series and the tags used to sort and combine the
+# slices into a volume. Any tags that are not in this list are skipped when reading the header.
+headerTags = [
+    # Patient
+    'PatientName', 'PatientID', 'IssuerOfPatientID', 'PatientBirthDate', 'PatientBirthTime', 'PatientSex',
+    'OtherPatientIDs', 'OtherPatientNames', 'PatientAge', 'PatientSize', 'PatientWeight', 'EthnicGroup',
+    'PatientComments', 'PatientIdentityRemoved', 'PatientPosition',
+    # Study
+    'StudyInstanceUID', 'StudyDate', 'StudyTime', 'StudyDescription',
+    # Series
+    'SeriesInstanceUID', 'SeriesDate', 'SeriesTime', 'SeriesDescription', 'SeriesNumber', 'Modality',
+    # Sorting
+    'SliceLocation', 'ImageOrientationPatient', 'ImagePositionPatient', 'TriggerTime', 'AcquisitionDateTime',
+    'AcquisitionTime', 'ImageNumber', 'InstanceNumber',
+    # Image
+    'PixelSpacing', 'Rows', 'Columns', 'SamplesPerPixel', 'BitsAllocated', 'BitsStored', 'PixelRepresentation',
+    'PhotometricInterpretation', 'RescaleSlope', 'RescaleIntercept'
+]
+
+
+def tagsForKeywords(keywords):
+    """
+    Converts DICOM keywords to tags. Keywords that are not in the DICOM dictionary are ignored.
+
+    :param keywords: List of DICOM keywords
+    :return: Returns a list of DICOM tags
+    """
+    tags = [pydicom.datadict.tag_for_keyword(keyword) for keyword in keywords]
+    return [tag for tag in tags if tag is not None]
+
+
+def matchesFilters(DCMImage, filters):
+    """
+    Checks whether a DICOM image matches all of the given filters.
+
+    Each filter is a DICOM keyword and a condition. The condition can be a callable that accepts the value and returns
+    true if it matches, a list, tuple or set of values where the value must be one of them, or a value that must be
+    equal. Images that are missing a tag in the filters do not match.
+
+    :param DCMImage: DICOM dataset to check
+    :param filters: Dictionary of DICOM keyword and condition
+    :return: Returns true if the image matches all of the filters, otherwise it returns false
+    """
+    for keyword, condition in filters.items():
+        value = DCMImage.get(keyword)
+
+        if value is None:
+            return False
+        elif callable(condition):
+            if not condition(value):
+                return False
+        elif isinstance(condition, (list, tuple, set, frozenset)):
+            if value not in condition:
+                return False
+        elif value != condition:
+            return False
+
+    return True
+
+
+def readDataset(filename, headerOnly=False, filters=None):
+    """
+    Reads a DICOM file from the given filename.
+
+    If headerOnly is true, then the file is read up to the pixel data and only the tags in headerTags are kept. The
+    pixel data can be loaded afterwards with readPixelArray.
+
+    If filters are given, only the tags in the filters are read first to check whether the image matches. The rest of
+    the file is only read if the image matches, so the pixel data of rejected images is never read.
+
+    :param filename: Filename of the DICOM file to read
+    :param headerOnly: Whether to only read the header tags necessary for organizing and sorting the images
+    :param filters: Dictionary of DICOM keyword and condition that the image must match, see matchesFilters
+    :return: Returns the DICOM dataset or None if the image does not match the filters
+    """
+    if headerOnly:
+        DCMImage = pydicom.dcmread(filename, stop_before_pixels=True,
+                                   specific_tags=tagsForKeywords(headerTags + list(filters or [])))
+
+        return DCMImage if not filters or matchesFilters(DCMImage, filters) else None
+
+    if filters:
+        # Read the tags used in the filters and stop if the image does not match
+        DCMImage = pydicom.dcmread(filename, stop_before_pixels=True, specific_tags=tagsForKeywords(filters))
+
+        if not matchesFilters(DCMImage, filters):
+            return None
+
+    return pydicom.dcmread(filename)
+
+
+def readPixelArray(dataset):
+    """
+    Retrieves the pixel array for the given dataset. If the dataset was loaded with only the header, then the file is
+    read again from disk to get the pixel data. The pixel data is not stored in the dataset in that case.
+
+    :param dataset: DICOM dataset to retrieve the pixel array from
+    :return: Returns the pixel array of the dataset
+    """
+    if 'PixelData' in dataset:
+        return dataset.pixel_array
+
+    return pydicom.dcmread(dataset.filename).pixel_array
+
+
+def findDICOMFiles(path):
+    """
+    Searches the directory recursively for DICOM files.
+
+    :param path: Directory to search
+    :return: Returns a list of filenames for each DICOM file in the directory
+    """
+    DCMFilenames = []
+    for dirName, subdirs, filenames in os.walk(path):
+        for filename in filenames:
+            if filename.endswith('.dcm'):
+                DCMFilenames.append(os.path.join(dirName, filename))
+
+    return DCMFilenames
+
+
+def readDatasets(filenames, headerOnly=False, workers=1, useProcesses=False, filters=None):
+    """
+    Reads the DICOM files given, optionally using a pool of threads or processes to read the files in parallel.
+
+    :param filenames: List of DICOM filenames to read
+    :param headerOnly: Whether to only read the header tags necessary for organizing and sorting the images
+    :param workers: Number of workers to read the files with. If 1, the files are read serially. If None, the number
+                    of workers is chosen by the executor based on the number of CPUs
+    :param useProcesses: Whether to use a process pool instead of a thread pool. When using a process pool, any
+                         callable conditions in the filters must be picklable (e.g. not a lambda)
+    :param filters: Dictionary of DICOM keyword and condition that the images must match, see matchesFilters
+    :return: Returns a list of DICOM datasets in the same order as the filenames. Images that do not match the filters
+             are None
+    """
+    read = functools.partial(readDataset, headerOnly=headerOnly, filters=filters)
+
+    if workers == 1:
+        return [read(filename) for filename in filenames]
+
+    executorClass = concurrent.futures.ProcessPoolExecutor if useProcesses else concurrent.futures.ThreadPoolExecutor
+    with executorClass(max_workers=workers) as executor:
+        return list(executor.map(read, filenames, chunksize=64 if useProcesses else 1))
+
+
+class SliceTable:
+    """
+    Columnar table of the tags used for sorting slices.
+
+    The tags are extracted from the datasets once and stored as NumPy arrays along with a mask of whether the tag is
+    present for each dataset. Missing values are stored as NaN. This allows selecting the method, computing the slice
+    positions and sorting the slices to be done with vectorized operations rather than looping over the datasets.
+    """
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+        count = len(datasets)
+
+        self.SliceLocation = np.full(count, np.nan)
+        self.ImagePositionPatient = np.full((count, 3), np.nan)
+        self.ImageOrientationPatient = np.full((count, 6), np.nan)
+        self.TriggerTime = np.full(count, np.nan)
+        self.AcquisitionDateTime = np.full(count, np.nan)
+        self.ImageNumber = np.full(count, np.nan)
+
+        self.present = {keyword: np.zeros(count, bool) for keyword in
+                        ['SliceLocation', 'ImagePositionPatient', 'ImageOrientationPatient', 'TriggerTime',
+                         'AcquisitionDateTime', 'ImageNumber']}
+
+        for i, d in enumerate(datasets):
+            for keyword, present in self.present.items():
+                value = d.get(keyword)
+                if value is None:
+                    continue
+
+                present[i] = True
+                if keyword == 'AcquisitionDateTime':
+                    # AcquisitionDateTime is stored as a timestamp in seconds
+                    value = value.timestamp()
+
+                getattr(self, keyword)[i] = value
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def isMethodAvailable(self, method):
+        """
+        Checks if a given method is available for all of the slices in the table.
+
+        :param method: Method to check whether it is available. Must be option from MethodType
+        :return: Returns true if method is available in dataset, otherwise it returns false
+        """
+        if method == MethodType.TriggerTime:
+            return bool(self.present['TriggerTime'].all())
+        elif method == MethodType.AcquisitionDateTime:
+            return bool(self.present['AcquisitionDateTime'].all())
+        elif method == MethodType.ImageNumber:
+            return bool(self.present['ImageNumber'].all())
+        elif method == MethodType.SliceLocation:
+            return bool(self.present['SliceLocation'].all())
+        elif method == MethodType.PatientLocation:
+            return bool((self.present['ImageOrientationPatient'] & self.present['ImagePositionPatient']).all())
+        else:
+            raise TypeError('Invalid method specified')
+
+    def isVarying(self, method):
+        """
+        Checks whether the values for the given method differ between slices. The method must be available.
+
+        :param method: Method to check. Must be option from MethodType
+        :return: Returns true if any slice has a different value than the first slice
+        """
+        if method == MethodType.PatientLocation:
+            return bool(np.any(self.ImageOrientationPatient != self.ImageOrientationPatient[0]) or
+                        np.any(self.ImagePositionPatient != self.ImagePositionPatient[0]))
+
+        values = self.values(method)
+        return bool(np.any(values != values[0]))
+
+    def sliceCosines(self):
+        """
+        Calculates the slice cosines from the image orientation of the first slice. The slice cosines is the cross
+        product of the row and column cosines.
+
+        :return: Returns the slice cosines as a NumPy array
+        """
+        # Row cosines is first 3 elements, column cosines is last 3 elements of array
+        return np.cross(self.ImageOrientationPatient[0, :3], self.ImageOrientationPatient[0, 3:])
+
+    def slicePositions(self):
+        """
+        Calculates the slice position of each slice from the image orientation and image position.
+
+        :return: Returns the slice cosines and a NumPy array of the slice positions
+        """
+        sliceCosines = self.sliceCosines()
+
+        # Slice location is dot product of slice cosines and the image patient position
+        return sliceCosines, self.ImagePositionPatient @ sliceCosines
+
+    def values(self, method):
+        """
+        Retrieves the values used to sort the slices for the given method.
+
+        :param method: Method to retrieve the values for. Must be option from MethodType
+        :return: Returns a NumPy array of the values for each slice
+        """
+        if method == MethodType.SliceLocation:
+            return self.SliceLocation
+        elif method == MethodType.PatientLocation:
+            return self.slicePositions()[1]
+        elif method == MethodType.TriggerTime:
+            return self.TriggerTime
+        elif method == MethodType.AcquisitionDateTime:
+            return self.AcquisitionDateTime
+        elif method == MethodType.ImageNumber:
+            return self.ImageNumber
+        else:
+            raise TypeError('Invalid method')
+
+    def sortOrder(self, method, reverse=False):
+        """
+        Calculates the order of the slices sorted by the values of the given method. The sort is stable so slices with
+        equal values stay in their original order.
+
+        :param method: Method to sort the slices by. Must be option from MethodType
+        :param reverse: Whether to sort the slices in descending order
+        :return: Returns a NumPy array of the indices of the sorted slices and the sorted values
+        """
+        values = self.values(method)
+        order = np.argsort(-values if reverse else values, kind='stable')
+
+        return order, values[order]
+
+
+def _sliceTable(datasets):
+    return datasets if isinstance(datasets, SliceTable) else SliceTable(datasets)
+
+
 def isMethodAvailable(datasets, method):
     """
     Checks if a given method is available from the dataset in the class. This checks the DICOM header for specified
     tags for each of the DICOM images.
 
-    :param datasets: List of DICOM images to be combined into a 3D volume
+    :param datasets: List of DICOM images to be combined into a 3D volume or a SliceTable
     :param method: Method to check whether it is available. Must be option from VolumeType
     :return: Returns true if method is available in dataset, otherwise it returns false
     """
 
-    if method == MethodType.TriggerTime:
-        return all(['TriggerTime' in d for d in datasets])
-    elif method == MethodType.AcquisitionDateTime:
-        return all(['AcquisitionDateTime' in d for d in datasets])
-    elif method == MethodType.ImageNumber:
-        return all(['ImageNumber' in d for d in datasets])
-    elif method == MethodType.SliceLocation:
-        return all(['SliceLocation' in d for d in datasets])
-    elif method == MethodType.PatientLocation:
-        return all(['ImageOrientationPatient' in d and 'ImagePositionPatient' in d for d in datasets])
-    else:
-        raise TypeError('Invalid method specified')
+    return _sliceTable(datasets).isMethodAvailable(method)
 
 
 def getBestMethod(datasets):
@@ -52,29 +327,25 @@ def getBestMethod(datasets):
 
     :return: Returns MethodType value representing the best method to use for combining slices
     """
+    table = _sliceTable(datasets)
+
     # noinspection PyUnusedLocal
     method = MethodType.Unknown
     type_ = VolumeType.Unknown
 
-    if isMethodAvailable(datasets, MethodType.SliceLocation) \
-            and any([datasets[0].SliceLocation != d.SliceLocation for d in datasets]):
+    if table.isMethodAvailable(MethodType.SliceLocation) and table.isVarying(MethodType.SliceLocation):
         method = MethodType.SliceLocation
         type_ = VolumeType.Spatial
-    elif isMethodAvailable(datasets, MethodType.PatientLocation) \
-            and any([datasets[0].ImageOrientationPatient != d.ImageOrientationPatient
-                     or datasets[0].ImagePositionPatient != d.ImagePositionPatient for d in datasets]):
+    elif table.isMethodAvailable(MethodType.PatientLocation) and table.isVarying(MethodType.PatientLocation):
         method = MethodType.PatientLocation
         type_ = VolumeType.Spatial
-    elif isMethodAvailable(datasets, MethodType.TriggerTime) \
-            and any([datasets[0].TriggerTime != d.TriggerTime for d in datasets]):
+    elif table.isMethodAvailable(MethodType.TriggerTime) and table.isVarying(MethodType.TriggerTime):
         method = MethodType.TriggerTime
         type_ = VolumeType.Temporal
-    elif isMethodAvailable(datasets, MethodType.AcquisitionDateTime) \
-            and any([datasets[0].AcquisitionDateTime != d.AcquisitionDateTime for d in datasets]):
+    elif table.isMethodAvailable(MethodType.AcquisitionDateTime) and table.isVarying(MethodType.AcquisitionDateTime):
         method = MethodType.AcquisitionDateTime
         type_ = VolumeType.Temporal
-    elif isMethodAvailable(datasets, MethodType.ImageNumber) \
-            and any([datasets[0].ImageNumber != d.ImageNumber for d in datasets]):
+    elif table.isMethodAvailable(MethodType.ImageNumber) and table.isVarying(MethodType.ImageNumber):
         method = MethodType.ImageNumber
     else:
         raise TypeError('Unable to find best method')
@@ -89,14 +360,6 @@ def slicePositionsFromPatientInfo(datasets):
 
     :return: Returns a list of slice positions for the current dataset.
     """
-    imageOrientation = datasets[0].ImageOrientationPatient
-
-    # Row cosines is first 3 elements, column cosines is last 3 elements of array
-    rowCosines = np.array(imageOrientation[:3])
-    colCosines = np.array(imageOrientation[3:])
-
-    # Get cross product of row and column cosines
-    sliceCosines = np.cross(rowCosines, colCosines)
+    sliceCosines, slicePositions = _sliceTable(datasets).slicePositions()
 
-    # Slice location is dot product of slice cosines and the image patient position
-    return sliceCosines.tolist(), [np.dot(sliceCosines, d.ImagePositionPatient) for d in datasets]
+    return sliceCosines.tolist(), slicePositions
@@ -141,7 +141,13 @@ class MainWindow(QMainWindow, mainWindow_ui.Ui_MainWindow):
         dicomDir = dataPath + "SCANS"
         print(dicomDir)
         # Load DICOM directory and organize by patients, studies, and series
-        patients = dicom2.loadDirectory(dicomDir)
+        # Only the headers are read here, the pixel data is read when the slices are combined
+        # The headers are cached in an index within the subject folder so only new or changed files are read again
+        # Each series stores compact slice records rather than the DICOM datasets to reduce memory usage
+        # Only the T1 series are loaded since the other series are not segmented
+        patients = dicom2.loadDirectory(dicomDir, headerOnly=True, workers=constants.DICOMLoadWorkers,
+                                        indexFilename=os.path.join(dataPath, constants.DICOMIndexFilename),
+                                        compact=True, seriesDescription=lambda x: x.startswith('t1_'))
         # Should only be one patient so retrieve it
         patient = patients.only()
         # Should only be one study so retrieve the one study
@@ -171,7 +177,7 @@ class MainWindow(QMainWindow, mainWindow_ui.Ui_MainWindow):
             print("Slices Sorted")
 
         (method, type_, space, orientation, spacing, origin, volume) = \
-            dicom2.combineSlices(sortedSeries, method=dicom2.MethodType.Unknown)
+            dicom2.combineSlices(sortedSeries, method=dicom2.MethodType.Unknown, workers=constants.DICOMLoadWorkers)
 
         nrrdHeaderDict = {'space': space, 'space origin': origin,
                           'space directions': (np.identity(3) * np.array(spacing)).tolist()}
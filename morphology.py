@@ -0,0 +1,66 @@
+import numpy as np
+import scipy.ndimage
+
+
+# Binary morphology of every slice along the last axis of a volume at once
+# The 2D structuring element or connectivity is stacked along the last axis, so each slice is processed independently
+# and the results are exactly the same as processing each slice with the 2D operation in scikit-image or SciPy. This
+# avoids the overhead of a separate call and the allocations for each slice
+
+
+# Stack a 2D structuring element along the last axis so that it does not connect neighbouring slices
+# The structure has a size of 3 along the last axis with the 2D structure in the middle since scipy.ndimage.label
+# requires each dimension of the structure to be 3
+def getSliceStructure(structure):
+    sliceStructure = np.zeros(np.shape(structure) + (3,), bool)
+    sliceStructure[:, :, 1] = structure
+
+    return sliceStructure
+
+
+# Same as skimage.morphology.binary_closing for each slice
+def binaryClosingSlices(masks, footprint):
+    structure = getSliceStructure(footprint)
+
+    # scikit-image treats the pixels outside the image as background for dilation and as foreground for erosion
+    dilatedMasks = scipy.ndimage.binary_dilation(masks, structure)
+
+    return scipy.ndimage.binary_erosion(dilatedMasks, structure, border_value=True)
+
+
+# Same as scipy.ndimage.binary_fill_holes for each slice
+# Rather than repeatedly dilating the background from the edges of the image like binary_fill_holes, the background is
+# labelled once and every background object that does not touch an edge of its slice is a hole
+def fillHolesSlices(masks):
+    structure = getSliceStructure(scipy.ndimage.generate_binary_structure(2, 1))
+    labels, labelCount = scipy.ndimage.label(np.logical_not(masks), structure)
+
+    # Label 0 is the foreground, which is kept
+    isBackground = np.zeros(labelCount + 1, bool)
+    for edge in (labels[0, :, :], labels[-1, :, :], labels[:, 0, :], labels[:, -1, :]):
+        isBackground[edge.ravel()] = True
+    isBackground[0] = False
+
+    return np.logical_not(isBackground[labels])
+
+
+# Remove small objects from each slice
+# Objects with fewer than minSize pixels are removed, objects are connected by the given connectivity within each slice
+# This is the same as skimage.morphology.remove_small_objects in older versions of scikit-image, newer versions also
+# remove objects with exactly minSize pixels. Use removeSmallObjects for a single slice so that the result does not
+# depend on the version of scikit-image
+def removeSmallObjectsSlices(masks, minSize, connectivity=1):
+    structure = getSliceStructure(scipy.ndimage.generate_binary_structure(2, connectivity))
+    labels, labelCount = scipy.ndimage.label(masks, structure)
+
+    # Background is label 0, which is already removed
+    sizes = np.bincount(labels.ravel(order='K'))
+    tooSmall = sizes < minSize
+    tooSmall[0] = True
+
+    return np.logical_not(tooSmall[labels])
+
+
+# Remove objects with fewer than minSize pixels from a single slice, see removeSmallObjectsSlices
+def removeSmallObjects(mask, minSize, connectivity=1):
+    return removeSmallObjectsSlices(mask[:, :, None], minSize, connectivity)[:, :, 0]
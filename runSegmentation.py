@@ -1,5 +1,6 @@
 import os
 import time
+import tracemalloc
 
 import scipy.ndimage.morphology
 import scipy.io
@@ -11,7 +12,12 @@ import nrrd
 import matplotlib.pyplot as plt
 
 import constants
-from biasCorrection import correctBias
+from biasCorrection import correctBias, getN4Parameters, chooseN4Parameters
+from biasFieldCache import BiasFieldCache
+from debugWriter import writeDebug, flushDebug
+from morphology import binaryClosingSlices, fillHolesSlices, removeSmallObjects, removeSmallObjectsSlices
+from sliceExecutor import executeSlices
+from boundary import boundaryEngines
 from utils import *
 
 
@@ -24,8 +30,20 @@ def getPath(path):
     return os.path.join(constants.pathDir, path)
 
 
-# noinspection PyUnusedLocal
-def segmentAbdomenSlice(slice, fatImageMask, bodyMask):
+# Get the cache for the N4 bias fields, None is returned if the cache is disabled
+def getBiasFieldCache():
+    if constants.biasFieldCacheDirectory is None:
+        directory = getPath('biasFieldCache')
+    elif constants.biasFieldCacheDirectory:
+        directory = constants.biasFieldCacheDirectory
+    else:
+        return None
+
+    return BiasFieldCache(directory, constants.biasFieldCacheMaxSize)
+
+
+# Fat voids are the regions without fat that are enclosed by fat, objects smaller than minSize are removed
+def getFatVoidMask(fatImageMask, minSize):
     # Fill holes in the fat image mask and invert it to get the background of fat image
     # OR the fat background mask and fat image mask and take NOT of mask to get the fat void mask
     fatBackgroundMask = np.logical_not(scipy.ndimage.morphology.binary_fill_holes(fatImageMask))
@@ -39,35 +57,24 @@ def segmentAbdomenSlice(slice, fatImageMask, bodyMask):
     # case because binary_opening with a 5x5 disk SE was removing long, skinny objects that were not
     # wide enough to pass the test. However, their area is larger than smaller objects that I need to
     # remove. So remove_small_objects is better since it utilizes area.
-    # Odd issue where a warning will appear saying that a boolean image should be given. This is a bug in skimage
-    # because I traced it down and the label function is returning odd values
-    fatVoidMask = skimage.morphology.remove_small_objects(fatVoidMask, constants.thresholdAbdominalFatVoidsArea)
+    # removeSmallObjects is used rather than the scikit-image function since newer versions of scikit-image also remove
+    # objects with exactly the threshold area, see morphology.py
+    fatVoidMask = removeSmallObjects(fatVoidMask, minSize)
+
+    return fatVoidMask
+
 
-    # Use active contours to get the abdominal mask
+# If state is given, the boundary engine may reuse results from the previous slice, see boundary.py
+# noinspection PyUnusedLocal
+def segmentAbdomenSlice(slice, fatImageMask, bodyMask, state=None):
+    fatVoidMask = getFatVoidMask(fatImageMask, constants.thresholdAbdominalFatVoidsArea)
+
+    # Find the abdominal mask from the fat voids, by default with active contours
     # Originally, I attempted this using the convex hull but I was not a huge fan of the results
     # since there were instances where the outline was concave and not convex
-    # For active contours, we need an initial contour. We will start with an outline of the body mask
-    # Find contours of body mask
-    image, contours, hierarchy = cv2.findContours(bodyMask.astype(np.uint8), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-
-    # Sort the contours by area and select the one with largest area, this will be the body mask contour
-    sortedContourArea = np.array([cv2.contourArea(contour) for contour in contours])
-    index = np.argmax(sortedContourArea)
-    initialContour = contours[index]
-    initialContour = initialContour.reshape(initialContour.shape[::2])
-
-    # Perform active contour snake algorithm to get outline of the abdominal mask
-    snakeContour = skimage.segmentation.active_contour(fatVoidMask.astype(np.uint8) * 255, initialContour, alpha=0.70,
-                                                       beta=0.01, gamma=0.1, max_iterations=2500, max_px_move=1.0,
-                                                       w_line=0.0, w_edge=5.0, convergence=0.1)
-
-    # Draw snake contour on abdominalMask variable
-    # Two options, polygon fills in the area and polygon_perimeter only draws the perimeter
-    # Perimeter is good for testing while polygon is the general use one
-    abdominalMask = np.zeros(fatVoidMask.shape, np.uint8)
-    rr, cc = skimage.draw.polygon(snakeContour[:, 0], snakeContour[:, 1])
-    # rr, cc = skimage.draw.polygon_perimeter(snakeContour[:, 0], snakeContour[:, 1])
-    abdominalMask[cc, rr] = 1
+    # The snake starts with an outline of the body mask, see boundary.py for the other engines
+    boundaryEngine = boundaryEngines[constants.boundaryEngine]
+    abdominalMask, iterations = boundaryEngine(fatVoidMask, bodyMask, state)
 
     # SCAT is all fat outside the abdominal mask
     # VAT is all fat inside the abdominal mask
@@ -75,12 +82,12 @@ def segmentAbdomenSlice(slice, fatImageMask, bodyMask):
     VAT = np.logical_and(abdominalMask, fatImageMask)
 
     # Remove objects from SCAT where the area is less than given constant
-    SCAT = skimage.morphology.remove_small_objects(SCAT, constants.minSCATObjectArea)
+    SCAT = removeSmallObjects(SCAT, constants.minSCATObjectArea)
 
     # Remove objects from VAT where the area is less than given constant
-    VAT = skimage.morphology.remove_small_objects(VAT, constants.minVATObjectArea)
+    VAT = removeSmallObjects(VAT, constants.minVATObjectArea)
 
-    return fatVoidMask, abdominalMask, SCAT, VAT
+    return fatVoidMask, abdominalMask, SCAT, VAT, iterations
 
 
 def segmentThoracicSlice(fatImageMask, bodyMask):
@@ -97,35 +104,16 @@ def segmentThoracicSlice(fatImageMask, bodyMask):
     # case because binary_opening with a 5x5 disk SE was removing long, skinny objects that were not
     # wide enough to pass the test. However, their area is larger than smaller objects that I need to
     # remove. So remove_small_objects is better since it utilizes area.
-    # Odd issue where a warning will appear saying that a boolean image should be given. This is a bug in skimage
-    # because I traced it down and the label function is returning odd values
-    fatVoidMask = skimage.morphology.remove_small_objects(fatVoidMask, constants.thresholdThoracicFatVoidsArea)
+    # removeSmallObjects is used rather than the scikit-image function since newer versions of scikit-image also remove
+    # objects with exactly the threshold area, see morphology.py
+    fatVoidMask = removeSmallObjects(fatVoidMask, constants.thresholdThoracicFatVoidsArea)
 
-    # Use active contours to get the abdominal mask
+    # Find the thoracic mask from the fat voids, by default with active contours
     # Originally, I attempted this using the convex hull but I was not a huge fan of the results
     # since there were instances where the outline was concave and not convex
-    # For active contours, we need an initial contour. We will start with an outline of the body mask
-    # Find contours of body mask
-    image, contours, hierarchy = cv2.findContours(bodyMask.astype(np.uint8), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-
-    # Sort the contours by area and select the one with largest area, this will be the body mask contour
-    sortedContourArea = np.array([cv2.contourArea(contour) for contour in contours])
-    index = np.argmax(sortedContourArea)
-    initialContour = contours[index]
-    initialContour = initialContour.reshape(initialContour.shape[::2])
-
-    # Perform active contour snake algorithm to get outline of the abdominal mask
-    snakeContour = skimage.segmentation.active_contour(fatVoidMask.astype(np.uint8) * 255, initialContour, alpha=0.70,
-                                                       beta=0.01, gamma=0.1, max_iterations=2500, max_px_move=1.0,
-                                                       w_line=0.0, w_edge=5.0, convergence=0.1)
-
-    # Draw snake contour on abdominalMask variable
-    # Two options, polygon fills in the area and polygon_perimeter only draws the perimeter
-    # Perimeter is good for testing while polygon is the general use one
-    thoracicMask = np.zeros(fatVoidMask.shape, np.uint8)
-    rr, cc = skimage.draw.polygon(snakeContour[:, 0], snakeContour[:, 1])
-    # rr, cc = skimage.draw.polygon_perimeter(snakeContour[:, 0], snakeContour[:, 1])
-    thoracicMask[cc, rr] = 1
+    # The snake starts with an outline of the body mask, see boundary.py for the other engines
+    boundaryEngine = boundaryEngines[constants.boundaryEngine]
+    thoracicMask, iterations = boundaryEngine(fatVoidMask, bodyMask)
 
     # Lungs are defined as being within body and not containing any fat or water content
     # lungMask = bodyMask & ~fatImageMask & ~waterImageMask
@@ -143,7 +131,7 @@ def segmentThoracicSlice(fatImageMask, bodyMask):
     CAT = np.zeros_like(ITAT, dtype=bool)
 
     # Remove objects from SCAT where the area is less than given constant
-    SCAT = skimage.morphology.remove_small_objects(SCAT, constants.minSCATObjectArea)
+    SCAT = removeSmallObjects(SCAT, constants.minSCATObjectArea)
 
     # if CATInferior <= slice <= CATSuperior:
     #     posterior = int(np.round(np.interp(slice, CATAxial, CATPosterior)))
@@ -194,6 +182,197 @@ def segmentThoracicSlice(fatImageMask, bodyMask):
     return fatVoidMask, thoracicMask, lungMask, SCAT, ITAT, CAT
 
 
+# Find the fat in a single axial slice of the image using K-means
+# Returns a dictionary with the fat image mask for the slice, see segmentSlice
+# state is shared between consecutive slices segmented by the same worker, see executeSlices
+# If volumeCentroids is given, it contains the K-means centroids of every slice that were calculated in one pass
+def clusterSlice(imageSlice, slice, state, umbilicisInferiorSlice, umbilicisSuperiorSlice, umbilicisLeft,
+                 umbilicisRight, umbilicisCoronal, volumeCentroids=None):
+    # waterImageSlice = waterImage[:, :, slice]
+
+    # Segment fat/water images using K-means
+    # labelOrder contains the labels sorted from smallest intensity to greatest
+    # Since our k = 2, we want the higher intensity label at index 1
+    # The random state is fixed so that the results are the same regardless of the order the slices are segmented
+    # With more than one pyramid level, the centroids are found from every Nth pixel of the slice along each axis
+    pyramidFactor = 2 ** (constants.pyramidLevels - 1)
+    clusterImage = imageSlice[::pyramidFactor, ::pyramidFactor]
+
+    if volumeCentroids is not None:
+        # Each pixel belongs to the nearest centroid, so fat is above the midpoint of the two centroids
+        fatImageMask = imageSlice > volumeCentroids[slice].mean()
+    elif constants.kMeansMethod == 'warmStart':
+        # Start from the centroids of the previous slice
+        if 'kMeans' not in state:
+            state['kMeans'] = WarmStartKMeans(2, constants.kMeansWarmStartIterations, constants.kMeansInertiaRatio,
+                                              constants.kMeansMaxDrift, constants.kMeansRandomState)
+
+        labelOrder, centroids, imageLabels = state['kMeans'].fit(clusterImage)
+        fatImageMask = (imageLabels == labelOrder[1])
+    elif constants.kMeansMethod == 'histogram':
+        labelOrder, centroids, imageLabels = kmeansHistogram(clusterImage, 2, constants.kMeansHistogramBins)
+        fatImageMask = (imageLabels == labelOrder[1])
+    elif constants.kMeansMethod == 'sklearn':
+        labelOrder, centroids, imageLabels = kmeans(clusterImage, 2, randomState=constants.kMeansRandomState)
+        fatImageMask = (imageLabels == labelOrder[1])
+    else:
+        raise TypeError('Invalid K-means method: %s' % constants.kMeansMethod)
+
+    # Pixels of the full slice belong to the nearest centroid when the centroids are found from fewer pixels
+    if volumeCentroids is None and pyramidFactor > 1:
+        fatImageMask = imageSlice > centroids.mean()
+    #plt.figure()
+    #plt.imshow(imageLabels*127, cmap="gray")
+    #plt.show()
+
+    # # Algorithm assumes that the skin is a closed contour and fully connects
+    # # This is a valid assumption but near the umbilicis, there is a discontinuity
+    # # so this draws a line near there to create a closed contour
+    if umbilicisInferiorSlice <= slice <= umbilicisSuperiorSlice:
+        fatImageMask[umbilicisLeft:umbilicisRight, umbilicisCoronal] = True
+
+    return {'fatImageMask': fatImageMask}
+
+
+# Segment a single axial slice of the image
+# Each slice is segmented independently of the others, so this is run for each slice by the slice executor
+# Returns a dictionary of the masks for the slice, the abdominal masks are only returned below the diaphragm
+# state is shared between consecutive slices segmented by the same worker, see executeSlices
+# If volumeCentroids is given, it contains the K-means centroids of every slice that were calculated in one pass
+# If region is given, it is the region of interest of the body for all slices, see getMaskRegion
+# If fatImageMask is given, it is the fat image mask of the slice from clusterSlice and the slice is not clustered again
+def segmentSlice(imageSlice, slice, state, diaphragmSuperiorSlice, umbilicisInferiorSlice, umbilicisSuperiorSlice,
+                 umbilicisLeft, umbilicisRight, umbilicisCoronal, volumeCentroids=None, region=None,
+                 fatImageMask=None):
+    if fatImageMask is None:
+        fatImageMask = clusterSlice(imageSlice, slice, state, umbilicisInferiorSlice, umbilicisSuperiorSlice,
+                                    umbilicisLeft, umbilicisRight, umbilicisCoronal, volumeCentroids)['fatImageMask']
+
+    # With a region of interest, the slice is only segmented inside the bounding box of the body plus a margin and
+    # slices without any body are skipped. Otherwise, the whole slice is segmented
+    if constants.segmentationROI == 'slice':
+        region = getMaskRegion(fatImageMask, constants.segmentationROIMargin)
+    elif not constants.segmentationROI:
+        region = np.s_[:, :]
+
+    if region is None or not fatImageMask[region].any():
+        return {'fatImageMask': fatImageMask}
+
+    fatImageMaskROI = fatImageMask[region]
+
+    #bodyMask = np.logical_or(fatImageMask, fatImageMask)
+    bodyMask = skimage.morphology.binary_closing(fatImageMaskROI, skimage.morphology.disk(3))
+    bodyMask = scipy.ndimage.morphology.binary_fill_holes(bodyMask)
+
+    results = {'bodyMask': bodyMask}
+
+    #Superior of diaphragm is divider between thoracic and abdominal region
+    if slice < diaphragmSuperiorSlice:
+        fatVoidMask, abdominalMask, SCATSlice, VATSlice, snakeIterations = \
+            segmentAbdomenSlice(slice, fatImageMaskROI, bodyMask, state if constants.snakeWarmStart else None)
+
+        results.update(fatVoidMask=fatVoidMask, abdominalMask=abdominalMask, SCAT=SCATSlice, VAT=VATSlice)
+        results = {name: pasteRegion(mask, region, fatImageMask.shape) for name, mask in results.items()}
+        results['snakeIterations'] = snakeIterations
+    else:
+        results = {name: pasteRegion(mask, region, fatImageMask.shape) for name, mask in results.items()}
+    # else:
+    #     fatVoidMask, thoracicMask, lungMask, SCAT, ITAT, CAT = segmentThoracicSlice(fatImageMask, bodyMask)
+    #
+    #     results.update(fatVoidMask=fatVoidMask, thoracicMask=thoracicMask, lungMask=lungMask, SCAT=SCATSlice,
+    #                    ITAT=ITATSlice, CAT=CATSlice)
+
+    results['fatImageMask'] = fatImageMask
+
+    return results
+
+
+# Body mask of every slice at once, this is the same as the body mask of each slice in segmentSlice
+def getBodyMasks(fatImageMasks):
+    bodyMasks = binaryClosingSlices(fatImageMasks, skimage.morphology.disk(3))
+
+    return fillHolesSlices(bodyMasks)
+
+
+# Fat void mask of every slice at once, this is the same as getFatVoidMask for each slice
+def getFatVoidMasks(fatImageMasks, minSize):
+    fatVoidMasks = np.logical_and(fillHolesSlices(fatImageMasks), np.logical_not(fatImageMasks))
+
+    return removeSmallObjectsSlices(fatVoidMasks, minSize)
+
+
+# Find the abdominal mask of a single axial slice from its fat void mask and body mask, see segmentAbdomenSlice
+# Slices without any body are skipped, the same as segmentSlice. With a region of interest, the boundary is only found
+# inside the bounding box of the body mask plus a margin
+# Returns a dictionary with the abdominal mask and number of snake iterations for the slice
+def segmentBoundarySlice(fatVoidMask, slice, state, bodyMask):
+    if not bodyMask.any():
+        return {}
+
+    if constants.segmentationROI:
+        region = getMaskRegion(bodyMask, constants.segmentationROIMargin)
+    else:
+        region = np.s_[:, :]
+
+    boundaryEngine = boundaryEngines[constants.boundaryEngine]
+    abdominalMask, iterations = boundaryEngine(fatVoidMask[region], bodyMask[region],
+                                               state if constants.snakeWarmStart else None)
+
+    return {'abdominalMask': pasteRegion(abdominalMask, region, fatVoidMask.shape), 'snakeIterations': iterations}
+
+
+# Segment all slices of the image with the morphology done on the whole volume at once
+# The K-means of each slice and the boundary of each abdominal slice are found slice by slice, while the body masks, fat
+# void masks and removal of small objects are done for all slices at once. The results are the same as segmentSlice
+# With a region of interest, the morphology is only done inside the bounding box of the body in all slices plus a margin
+# Returns the same outputs and slice information as executeSlices with segmentSlice, the slice information is from the
+# boundary of the abdominal slices
+def segmentVolume(image, workers, blockSize, seedSlice, diaphragmSuperiorSlice, umbilicisInferiorSlice,
+                  umbilicisSuperiorSlice, umbilicisLeft, umbilicisRight, umbilicisCoronal, volumeCentroids=None):
+    outputs, _ = executeSlices(clusterSlice, image, {'fatImageMask': bool}, workers=workers, blockSize=blockSize,
+                               seedSlice=seedSlice, umbilicisInferiorSlice=umbilicisInferiorSlice,
+                               umbilicisSuperiorSlice=umbilicisSuperiorSlice, umbilicisLeft=umbilicisLeft,
+                               umbilicisRight=umbilicisRight, umbilicisCoronal=umbilicisCoronal,
+                               volumeCentroids=volumeCentroids)
+    fatImageMasks = outputs['fatImageMask']
+    outputs.update({name: np.zeros(image.shape, bool, order='F') for name in ['bodyMask', 'fatVoidMask',
+                                                                                'abdominalMask', 'SCAT', 'VAT']})
+
+    if constants.segmentationROI:
+        region = getMaskRegion(fatImageMasks, constants.segmentationROIMargin)
+        if region is None:
+            return outputs, []
+    else:
+        region = np.s_[:, :]
+
+    # Superior of diaphragm is divider between thoracic and abdominal region, the abdominal slices are the first slices
+    abdominalRegion = region + (slice(0, min(diaphragmSuperiorSlice, image.shape[2])),)
+
+    outputs['bodyMask'][region] = getBodyMasks(fatImageMasks[region])
+    sliceStats = []
+
+    if abdominalRegion[2].stop > 0:
+        outputs['fatVoidMask'][abdominalRegion] = getFatVoidMasks(fatImageMasks[abdominalRegion],
+                                                                  constants.thresholdAbdominalFatVoidsArea)
+
+        boundaryOutputs, sliceStats = executeSlices(segmentBoundarySlice, outputs['fatVoidMask'][abdominalRegion],
+                                                    {'abdominalMask': bool}, workers=workers, blockSize=blockSize,
+                                                    seedSlice=seedSlice,
+                                                    sliceInputs={'bodyMask': outputs['bodyMask'][abdominalRegion]})
+        outputs['abdominalMask'][abdominalRegion] = boundaryOutputs['abdominalMask']
+
+        # SCAT is all fat outside the abdominal mask and VAT is all fat inside the abdominal mask
+        # Objects where the area is less than the given constants are removed
+        fatImageMasksAbdomen = fatImageMasks[abdominalRegion]
+        abdominalMasksAbdomen = outputs['abdominalMask'][abdominalRegion]
+        outputs['SCAT'][abdominalRegion] = removeSmallObjectsSlices(
+            np.logical_and(np.logical_not(abdominalMasksAbdomen), fatImageMasksAbdomen), constants.minSCATObjectArea)
+        outputs['VAT'][abdominalRegion] = removeSmallObjectsSlices(
+            np.logical_and(abdominalMasksAbdomen, fatImageMasksAbdomen), constants.minVATObjectArea)
+
+    return outputs, sliceStats
+
+
 # Segment depots of adipose tissue given Dixon MRI images
 def runSegmentation(image, config):
     # Create debug directory regardless of whether debug constant is true
@@ -274,83 +453,120 @@ def runSegmentation(image, config):
     fatImage, header = nrrd.read(getDebugPath(
         "C:/Users/Clint/PycharmProjects/SIUE-Dixon-Fat-Segmentation-Algorithm/MRI_Data_Nrrd_Output/newOut.nrrd"))
 
-    if os.path.exists(getDebugPath('C:/Users/Clint/PycharmProjects/SIUE-Dixon-Fat-Segmentation-Algorithm/MRI_Data_Nrrd_Output/fatImageBC.nrrd')):
-        fatImage, header = nrrd.read(getDebugPath('fatImageBC.nrrd'))
+    # Perform bias correction on MRI image to remove inhomogeneity
+    # The bias field is cached based on the contents of the image and the parameters, so the N4 correction is only
+    # performed if the image or parameters change
+    # If a time budget is given, the shrink factor and iteration schedule are chosen to fit within it. The chosen
+    # parameters are cached as well, so the calibration is only run once for each image size
+    # If enabled, the peak memory for the stage is measured with tracemalloc, which tracks the NumPy arrays but not the
+    # memory allocated internally by SimpleITK
+    if constants.measureBiasCorrectionMemory:
+        tracemalloc.start()
+
+    tic = time.perf_counter()
+    fatImage = np.asarray(fatImage, dtype=np.float32)
+    biasFieldCache = getBiasFieldCache()
+    if constants.N4TimeBudget:
+        N4Parameters = chooseN4Parameters(fatImage, constants.N4TimeBudget, numberOfThreads=constants.N4Threads,
+                                          cache=biasFieldCache)
     else:
-        fatImage = correctBias(fatImage.astype(np.float32), shrinkFactor=constants.shrinkFactor,
-                               prefix='fatImageBiasCorrection')
-    #
-    #         # If bias correction is performed, saved images to speed up algorithm in future runs
-    nrrd.write(getDebugPath('C:/Users/Clint/PycharmProjects/SIUE-Dixon-Fat-Segmentation-Algorithm/MRI_Data_Nrrd_Output/fatImageBC.nrrd'), fatImage, constants.nrrdHeaderDict)
+        N4Parameters = getN4Parameters()
+
+    fatImage = correctBias(fatImage, shrinkFactor=N4Parameters['shrinkFactor'], prefix='fatImageBiasCorrection',
+                           cache=biasFieldCache, N4Parameters=N4Parameters,
+                           numberOfThreads=constants.N4Threads, lowMemory=constants.biasCorrectionLowMemory)
 
+    toc = time.perf_counter()
+    print('N4ITK bias field correction took %f seconds' % (toc - tic))
 
-    fatImageMasks = np.zeros(fatImage.shape, bool)
-    bodyMasks = np.zeros(fatImage.shape, bool)
-    fatVoidMasks = np.zeros(fatImage.shape, bool)
-    abdominalMasks = np.zeros(fatImage.shape, bool)
+    if constants.measureBiasCorrectionMemory:
+        _, peakMemory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('N4ITK bias field correction peak memory %f MB' % (peakMemory / 1024 ** 2))
+
+    writeDebug(constants.debug, '', 'fatImageBC.nrrd', fatImage, constants.nrrdHeaderDict)
 
     # Final 3D volume results
-    SCAT = np.zeros(fatImage.shape, bool)
-    VAT = np.zeros(fatImage.shape, bool)
     ITAT = np.zeros(fatImage.shape, bool)
     CAT = np.zeros(fatImage.shape, bool)
-    #
-
 
-    for slice in range(0, image.shape[2]):  # 0, diaphragmSuperiorSlice): # fatImage.shape[2]):
-        tic = time.perf_counter()
+    # Each slice is segmented independently, in parallel when segmentationWorkers is more than one
+    # The intermediate images of each slice are kept in 3D volumes to print out for debugging afterwards
+    tic = time.perf_counter()
 
-        imageSlice = image[:, :, slice]
-        # waterImageSlice = waterImage[:, :, slice]
-
-        # Segment fat/water images using K-means
-        # labelOrder contains the labels sorted from smallest intensity to greatest
-        # Since our k = 2, we want the higher intensity label at index 1
-        labelOrder, centroids, imageLabels = kmeans(imageSlice, 2)
-        fatImageMask = (imageLabels == labelOrder[1])
-        #plt.figure()
-        #plt.imshow(imageLabels*127, cmap="gray")
-        #plt.show()
-
-
-
-        # # Algorithm assumes that the skin is a closed contour and fully connects
-        # # This is a valid assumption but near the umbilicis, there is a discontinuity
-        # # so this draws a line near there to create a closed contour
-        if umbilicisInferiorSlice <= slice <= umbilicisSuperiorSlice:
-            fatImageMask[umbilicisLeft:umbilicisRight, umbilicisCoronal] = True
-        #
-        fatImageMasks[:, :, slice] = fatImageMask
-
-        #bodyMask = np.logical_or(fatImageMask, fatImageMask)
-        bodyMask = skimage.morphology.binary_closing(fatImageMask, skimage.morphology.disk(3))
-        bodyMask = scipy.ndimage.morphology.binary_fill_holes(bodyMask)
-        bodyMasks[:, :, slice] = bodyMask
-
-        #Superior of diaphragm is divider between thoracic and abdominal region
-        if slice < diaphragmSuperiorSlice:
-            fatVoidMask, abdominalMask, SCATSlice, VATSlice = \
-                segmentAbdomenSlice(slice, fatImageMask, bodyMask)
-
-            fatVoidMasks[:, :, slice] = fatVoidMask
-            abdominalMasks[:, :, slice] = abdominalMask
-            SCAT[:, :, slice] = SCATSlice
-            VAT[:, :, slice] = VATSlice
-        # else:
-        #     fatVoidMask, thoracicMask, lungMask, SCAT, ITAT, CAT = segmentThoracicSlice(fatImageMask, bodyMask)
-        #
-        #     fatVoidMasks[:, :, slice] = fatVoidMask
-        #     thoracicMasks[:, :, slice] = thoracicMask
-        #     lungMasks[:, :, slice] = lungMask
-        #     SCAT[:, :, slice] = SCATSlice
-        #     ITAT[:, :, slice] = ITATSlice
-        #     CAT[:, :, slice] = CATSlice
-
-    if constants.debug:
-        nrrd.write(getDebugPath("C:/Users/Clint/PycharmProjects/SIUE-Dixon-Fat-Segmentation-Algorithm/MRI_Data_Nrrd_Output/fatImageMask.nrrd"), skimage.img_as_ubyte(fatImageMasks), constants.nrrdHeaderDict)
-        nrrd.write(getDebugPath("C:/Users/Clint/PycharmProjects/SIUE-Dixon-Fat-Segmentation-Algorithm/MRI_Data_Nrrd_Output/bodyMask.nrrd"), skimage.img_as_ubyte(bodyMasks), constants.nrrdHeaderDict)
-        nrrd.write(getDebugPath("C:/Users/Clint/PycharmProjects/SIUE-Dixon-Fat-Segmentation-Algorithm/MRI_Data_Nrrd_Output/fatVoidMask.nrrd"), skimage.img_as_ubyte(fatVoidMasks), constants.nrrdHeaderDict)
-        nrrd.write(getDebugPath("C:/Users/Clint/PycharmProjects/SIUE-Dixon-Fat-Segmentation-Algorithm/MRI_Data_Nrrd_Output/abdominalMask.nrrd"),skimage.img_as_ubyte(abdominalMasks), constants.nrrdHeaderDict)
+    # Cluster all of the slices in one vectorized pass before segmenting the slices
+    if constants.kMeansMethod == 'histogramVolume':
+        volumeCentroids = histogramCentroids(image, constants.kMeansHistogramBins)
+    else:
+        volumeCentroids = None
+
+    # When warm starting the snake, the slices are segmented outward from the seed slice in both directions
+    # The seed slice defaults to the middle of the abdominal slices
+    if constants.snakeWarmStart:
+        seedSlice = constants.snakeSeedSlice
+        if seedSlice is None:
+            seedSlice = min(diaphragmSuperiorSlice, image.shape[2]) // 2
+    else:
+        seedSlice = None
+
+    # The region of interest for all slices is needed before the slices are segmented independently, so all slices are
+    # clustered first in the same order as segmentSlice would. The fat image masks are then given to segmentSlice so
+    # that the slices are not clustered again
+    sliceInputs = None
+    if constants.segmentationROI == 'volume' and not constants.volumeMorphology:
+        clusterOutputs, _ = executeSlices(clusterSlice, image, {'fatImageMask': bool},
+                                          workers=constants.segmentationWorkers,
+                                          blockSize=constants.segmentationBlockSize, seedSlice=seedSlice,
+                                          umbilicisInferiorSlice=umbilicisInferiorSlice,
+                                          umbilicisSuperiorSlice=umbilicisSuperiorSlice, umbilicisLeft=umbilicisLeft,
+                                          umbilicisRight=umbilicisRight, umbilicisCoronal=umbilicisCoronal,
+                                          volumeCentroids=volumeCentroids)
+        sliceInputs = {'fatImageMask': clusterOutputs['fatImageMask']}
+        region = getMaskRegion(sliceInputs['fatImageMask'], constants.segmentationROIMargin)
+    else:
+        region = None
+
+    # The morphology is either done for each slice or for all slices at once
+    if constants.volumeMorphology:
+        outputs, sliceStats = segmentVolume(image, constants.segmentationWorkers, constants.segmentationBlockSize,
+                                            seedSlice, diaphragmSuperiorSlice, umbilicisInferiorSlice,
+                                            umbilicisSuperiorSlice, umbilicisLeft, umbilicisRight, umbilicisCoronal,
+                                            volumeCentroids)
+    else:
+        outputs, sliceStats = executeSlices(segmentSlice, image,
+                                            {name: bool for name in ['fatImageMask', 'bodyMask', 'fatVoidMask',
+                                                                     'abdominalMask', 'SCAT', 'VAT']},
+                                            workers=constants.segmentationWorkers,
+                                            blockSize=constants.segmentationBlockSize, seedSlice=seedSlice,
+                                            sliceInputs=sliceInputs, diaphragmSuperiorSlice=diaphragmSuperiorSlice,
+                                            umbilicisInferiorSlice=umbilicisInferiorSlice,
+                                            umbilicisSuperiorSlice=umbilicisSuperiorSlice, umbilicisLeft=umbilicisLeft,
+                                            umbilicisRight=umbilicisRight, umbilicisCoronal=umbilicisCoronal,
+                                            volumeCentroids=volumeCentroids, region=region)
+    toc = time.perf_counter()
+    print('Segmentation of %i slices took %f seconds' % (image.shape[2], toc - tic))
+
+    # Report the number of snake iterations for each slice to measure the effect of warm starting the snake
+    snakeIterations = [(slice, info['snakeIterations']) for slice, _, info in sliceStats if 'snakeIterations' in info]
+    if snakeIterations:
+        print('Snake iterations per slice: %s' % ', '.join('%i: %i' % x for x in snakeIterations))
+        print('Snake iterations total: %i' % sum(x[1] for x in snakeIterations))
+
+    fatImageMasks = outputs['fatImageMask']
+    bodyMasks = outputs['bodyMask']
+    fatVoidMasks = outputs['fatVoidMask']
+    abdominalMasks = outputs['abdominalMask']
+    SCAT = outputs['SCAT']
+    VAT = outputs['VAT']
+
+    # Debug volumes are converted to 8-bit on the background writer thread
+    writeDebug(constants.debug, '', "C:/Users/Clint/PycharmProjects/SIUE-Dixon-Fat-Segmentation-Algorithm/MRI_Data_Nrrd_Output/fatImageMask.nrrd", fatImageMasks, constants.nrrdHeaderDict, skimage.img_as_ubyte)
+    writeDebug(constants.debug, '', "C:/Users/Clint/PycharmProjects/SIUE-Dixon-Fat-Segmentation-Algorithm/MRI_Data_Nrrd_Output/bodyMask.nrrd", bodyMasks, constants.nrrdHeaderDict, skimage.img_as_ubyte)
+    writeDebug(constants.debug, '', "C:/Users/Clint/PycharmProjects/SIUE-Dixon-Fat-Segmentation-Algorithm/MRI_Data_Nrrd_Output/fatVoidMask.nrrd", fatVoidMasks, constants.nrrdHeaderDict, skimage.img_as_ubyte)
+    writeDebug(constants.debug, '', "C:/Users/Clint/PycharmProjects/SIUE-Dixon-Fat-Segmentation-Algorithm/MRI_Data_Nrrd_Output/abdominalMask.nrrd", abdominalMasks, constants.nrrdHeaderDict, skimage.img_as_ubyte)
+
+    # Wait for the debug files to be written before returning
+    flushDebug()
 
     ###OLD RUN SEGMENTATION###
     # import os
@@ -0,0 +1,188 @@
+import ctypes
+import math
+import multiprocessing
+import os
+import time
+
+import cv2
+import numpy as np
+
+import constants
+
+# Environment variables that set the number of threads used by BLAS and OpenMP libraries
+threadEnvironmentVariables = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                              'NUMEXPR_NUM_THREADS']
+
+# State of each worker process that is set when the worker is started, see initializeWorker
+_workerState = {}
+
+
+# Create an array in shared memory that can be passed to worker processes when they are started
+# Volumes are stored in Fortran order so that each slice along the last axis is contiguous
+# Returns a tuple of the shared buffer, shape and data type, see getSharedArray
+def createSharedArray(shape, dtype):
+    dtype = np.dtype(dtype)
+    buffer = multiprocessing.RawArray(ctypes.c_uint8, max(int(np.prod(shape)) * dtype.itemsize, 1))
+
+    return buffer, tuple(shape), dtype.str
+
+
+# Get a NumPy array that uses the shared buffer from createSharedArray, no data is copied
+def getSharedArray(sharedArray):
+    buffer, shape, dtype = sharedArray
+
+    return np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape))).reshape(shape, order='F')
+
+
+# Run the slice function for each of the given slices in order and store the results in the output volumes
+# The slice function is called with the image slice, the slice index, a state dictionary and the keyword arguments. It
+# returns a dictionary of the output name and the resulting 2D array for that slice. Outputs not returned are left as
+# zero and any results that are not outputs, such as iteration counts, are kept as information about the slice. The
+# state dictionary starts empty and is shared by the given slices, which allows the slice function to reuse results
+# from the previous slice. The slice of each of the inputs is passed as a keyword argument with the name of the input
+# Returns a list of the slice index, the time in seconds it took to process the slice and the slice information
+def runSlices(function, image, outputs, slices, kwargs, inputs=None):
+    state = {}
+    sliceStats = []
+    for slice in slices:
+        tic = time.perf_counter()
+
+        sliceInputs = {name: input[:, :, slice] for name, input in inputs.items()} if inputs else {}
+        results = function(image[:, :, slice], slice, state, **sliceInputs, **kwargs)
+
+        info = {}
+        for name, result in results.items():
+            if name in outputs:
+                outputs[name][:, :, slice] = result
+            else:
+                info[name] = result
+
+        toc = time.perf_counter()
+        sliceStats.append((slice, toc - tic, info))
+
+    return sliceStats
+
+
+# Start a worker process with the shared input and output volumes
+# The constants from the parent process are copied since they may have been changed at runtime
+def initializeWorker(function, sharedImage, sharedOutputs, sharedInputs, kwargs, constantsState):
+    vars(constants).update(constantsState)
+
+    # Each worker processes one slice at a time, so limit the number of threads to prevent oversubscribing the CPUs
+    cv2.setNumThreads(1)
+
+    _workerState['function'] = function
+    _workerState['image'] = getSharedArray(sharedImage)
+    _workerState['outputs'] = {name: getSharedArray(sharedOutput) for name, sharedOutput in sharedOutputs.items()}
+    _workerState['inputs'] = {name: getSharedArray(sharedInput) for name, sharedInput in sharedInputs.items()}
+    _workerState['kwargs'] = kwargs
+
+
+def runWorkerSlices(slices):
+    return runSlices(_workerState['function'], _workerState['image'], _workerState['outputs'], slices,
+                     _workerState['kwargs'], _workerState['inputs'])
+
+
+# Split the slices into contiguous blocks of slices, each block is processed by one worker at a time
+# The state of the slice function is shared within each block, see runSlices
+# If seedSlice is given, the slices are processed outward from the seed slice in both directions. The blocks above the
+# seed slice are in ascending order and the blocks below are in descending order. The seed slice is the first slice
+# of both directions so that the first block in each direction can reuse the results from the seed slice. The seed
+# slice has the same result both times since it is the first slice of both blocks
+def getSliceBlocks(sliceCount, workers, blockSize=None, seedSlice=None):
+    if not blockSize:
+        # Several blocks per worker balances the load when some slices take longer than others
+        blockSize = max(math.ceil(sliceCount / (workers * 4)), 1)
+
+    if seedSlice is None:
+        return [range(start, min(start + blockSize, sliceCount)) for start in range(0, sliceCount, blockSize)]
+
+    seedSlice = min(max(seedSlice, 0), sliceCount - 1)
+    blocks = [range(start, min(start + blockSize, sliceCount)) for start in range(seedSlice, sliceCount, blockSize)]
+    blocks += [range(start, max(start - blockSize, -1), -1) for start in range(seedSlice, -1, -blockSize)
+               if start != seedSlice or seedSlice > 0]
+
+    return blocks
+
+
+# Sort the slice information by slice index and keep only the first entry for each slice
+# The seed slice is processed at the start of the blocks in both directions, see getSliceBlocks, but it is only counted
+# once so that totals over the slices, such as the number of snake iterations, are not inflated
+def getUniqueSliceStats(sliceStats):
+    uniqueSliceStats = {}
+    for sliceStat in sorted(sliceStats, key=lambda x: x[0]):
+        uniqueSliceStats.setdefault(sliceStat[0], sliceStat)
+
+    return list(uniqueSliceStats.values())
+
+
+# Process each slice along the last axis of the image independently with the slice function, see runSlices
+# If workers is greater than one, the slices are processed in parallel on a pool of worker processes. The image and
+# output volumes are stored in shared memory so that the slices are not copied to the workers. The results are the
+# same regardless of the number of workers as long as the slice function is deterministic and blockSize is given, since
+# the blocks of slices that share state depend on the number of workers otherwise.
+# The slice function and keyword arguments must be picklable when using workers
+# outputTypes is a dictionary of the output name and the data type of the output volume
+# seedSlice is the slice to process outward from, see getSliceBlocks
+# sliceInputs is a dictionary of the name and volume of additional inputs with the same number of slices as the image,
+# the slice of each input is passed to the slice function as a keyword argument. Inputs are shared the same as the image
+# Returns a dictionary of the output name and output volume along with a list of the slice index, processing time and
+# information for each slice, see runSlices. Each slice appears once, including a seed slice, see getUniqueSliceStats
+def executeSlices(function, image, outputTypes, workers=1, blockSize=None, seedSlice=None, sliceInputs=None,
+                  **kwargs):
+    sliceCount = image.shape[2]
+    sliceInputs = sliceInputs or {}
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers <= 1 or sliceCount <= 1:
+        outputs = {name: np.zeros(image.shape, dtype, order='F') for name, dtype in outputTypes.items()}
+
+        sliceStats = []
+        for slices in getSliceBlocks(sliceCount, 1, blockSize, seedSlice):
+            sliceStats.extend(runSlices(function, image, outputs, slices, kwargs, sliceInputs))
+
+        return outputs, getUniqueSliceStats(sliceStats)
+
+    sharedImage = createSharedArray(image.shape, image.dtype)
+    getSharedArray(sharedImage)[:] = image
+
+    sharedInputs = {}
+    for name, input in sliceInputs.items():
+        sharedInputs[name] = createSharedArray(input.shape, input.dtype)
+        getSharedArray(sharedInputs[name])[:] = input
+
+    sharedOutputs = {name: createSharedArray(image.shape, dtype) for name, dtype in outputTypes.items()}
+    constantsState = {name: value for name, value in vars(constants).items() if not name.startswith('__')}
+
+    # Worker processes read the environment variables when they start, so set them before starting the pool
+    previousEnvironment = {name: os.environ.get(name) for name in threadEnvironmentVariables}
+    os.environ.update({name: '1' for name in threadEnvironmentVariables})
+
+    try:
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(min(workers, sliceCount), initializer=initializeWorker,
+                            initargs=(function, sharedImage, sharedOutputs, sharedInputs, kwargs, constantsState))
+    finally:
+        for name, value in previousEnvironment.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    try:
+        sliceStats = []
+        for blockStats in pool.imap_unordered(runWorkerSlices,
+                                              getSliceBlocks(sliceCount, workers, blockSize, seedSlice)):
+            sliceStats.extend(blockStats)
+
+        pool.close()
+        pool.join()
+    except BaseException:
+        pool.terminate()
+        raise
+
+    outputs = {name: getSharedArray(sharedOutput) for name, sharedOutput in sharedOutputs.items()}
+
+    return outputs, getUniqueSliceStats(sliceStats)
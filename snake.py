@@ -0,0 +1,214 @@
+import cv2
+import numpy as np
+import scipy.interpolate
+import scipy.linalg
+import skimage
+import skimage.filters
+import skimage.measure
+
+
+# Active contour model (snake) that is fit to features of an image
+# This is the algorithm of skimage.segmentation.active_contour in older versions of scikit-image, with periodic
+# boundary conditions and the snake given as (x, y) coordinates. Newer versions do not copy the edge rows and columns of
+# the edge image, so the fitted snake is close to but not the same as newer versions. Unlike skimage, the number of
+# iterations that were run is returned, which is used to measure how quickly the snake converges from different initial
+# contours.
+# Returns the fitted snake as an Nx2 array of (x, y) coordinates and the number of iterations
+def activeContour(image, snake, alpha=0.01, beta=0.1, wLine=0.0, wEdge=1.0, gamma=0.01, maxPixelMove=1.0,
+                  maxIterations=2500, convergence=0.1):
+    maxIterations = int(maxIterations)
+    if maxIterations <= 0:
+        raise TypeError('Maximum number of iterations must be greater than zero')
+
+    # Number of previous snakes to compare against when checking for convergence since the snake can oscillate
+    convergenceOrder = 10
+
+    image = skimage.img_as_float(image)
+
+    # Find edges using the Sobel filter, the edges of the edge image are copied from the pixels next to them
+    if wEdge != 0:
+        edge = skimage.filters.sobel(image)
+        edge[0, :] = edge[1, :]
+        edge[-1, :] = edge[-2, :]
+        edge[:, 0] = edge[:, 1]
+        edge[:, -1] = edge[:, -2]
+    else:
+        edge = 0
+
+    # Superimpose intensity and edge images and interpolate for smoothness
+    image = wLine * image + wEdge * edge
+    interpolator = scipy.interpolate.RectBivariateSpline(np.arange(image.shape[1]), np.arange(image.shape[0]),
+                                                         image.T, kx=2, ky=2, s=0)
+
+    x, y = snake[:, 0].astype(float), snake[:, 1].astype(float)
+    xSave = np.empty((convergenceOrder, len(x)))
+    ySave = np.empty((convergenceOrder, len(x)))
+
+    # Build snake shape matrix for Euler equation using central differences for the second and fourth order derivatives
+    n = len(x)
+    a = np.roll(np.eye(n), -1, axis=0) + np.roll(np.eye(n), -1, axis=1) - 2 * np.eye(n)
+    b = np.roll(np.eye(n), -2, axis=0) + np.roll(np.eye(n), -2, axis=1) - \
+        4 * np.roll(np.eye(n), -1, axis=0) - 4 * np.roll(np.eye(n), -1, axis=1) + 6 * np.eye(n)
+    A = -alpha * a + beta * b
+
+    # Only one inversion is needed for implicit spline energy minimization
+    inverse = scipy.linalg.inv(A + gamma * np.eye(n))
+
+    # Explicit time stepping for image energy minimization
+    iteration = 0
+    for iteration in range(1, maxIterations + 1):
+        fx = interpolator(x, y, dx=1, grid=False)
+        fy = interpolator(x, y, dy=1, grid=False)
+        xn = np.dot(inverse, gamma * x + fx)
+        yn = np.dot(inverse, gamma * y + fy)
+
+        # Movements are capped to maxPixelMove per iteration
+        x += maxPixelMove * np.tanh(xn - x)
+        y += maxPixelMove * np.tanh(yn - y)
+
+        # Convergence criteria needs to compare to a number of previous configurations since oscillations can occur
+        j = (iteration - 1) % (convergenceOrder + 1)
+        if j < convergenceOrder:
+            xSave[j, :] = x
+            ySave[j, :] = y
+        else:
+            distance = np.min(np.max(np.abs(xSave - x[None, :]) + np.abs(ySave - y[None, :]), 1))
+            if distance < convergence:
+                break
+
+    return np.array([x, y]).T, iteration
+
+
+# Active contour model (snake) with the same parameters as activeContour and approximately the same result but quicker
+# The matrix of the internal energy is a cyclic pentadiagonal (circulant) matrix since the snake is periodic, so each
+# iteration is solved using the FFT in O(N log N) rather than multiplying by a dense N x N inverse. The gradient of the
+# external energy is evaluated on a half pixel grid once and then bilinearly interpolated at the snake points on each
+# iteration rather than evaluating the spline for every point. All calculations are in float32. The snake is sensitive
+# to small differences in the forces, so the fitted snake is close to activeContour but not identical
+# Returns the fitted snake as an Nx2 array of (x, y) coordinates and the number of iterations
+def activeContourBanded(image, snake, alpha=0.01, beta=0.1, wLine=0.0, wEdge=1.0, gamma=0.01, maxPixelMove=1.0,
+                        maxIterations=2500, convergence=0.1):
+    maxIterations = int(maxIterations)
+    if maxIterations <= 0:
+        raise TypeError('Maximum number of iterations must be greater than zero')
+
+    # Number of previous snakes to compare against when checking for convergence since the snake can oscillate
+    convergenceOrder = 10
+
+    image = skimage.img_as_float(image)
+
+    # Find edges using the Sobel filter, the edges of the edge image are copied from the pixels next to them
+    if wEdge != 0:
+        edge = skimage.filters.sobel(image)
+        edge[0, :] = edge[1, :]
+        edge[-1, :] = edge[-2, :]
+        edge[:, 0] = edge[:, 1]
+        edge[:, -1] = edge[:, -2]
+    else:
+        edge = 0
+
+    # Superimpose intensity and edge images and calculate the gradient of the smooth interpolation at each half pixel
+    # The force fields are indexed by (2 * x, 2 * y)
+    image = wLine * image + wEdge * edge
+    interpolator = scipy.interpolate.RectBivariateSpline(np.arange(image.shape[1]), np.arange(image.shape[0]),
+                                                         image.T, kx=2, ky=2, s=0)
+    columns, rows = np.arange(2 * image.shape[1] - 1) / 2, np.arange(2 * image.shape[0] - 1) / 2
+    forceX = interpolator(columns, rows, dx=1).astype(np.float32)
+    forceY = interpolator(columns, rows, dy=1).astype(np.float32)
+    maximumIndex = np.array([len(columns) - 1, len(rows) - 1], dtype=np.float32)
+
+    points = np.ascontiguousarray(snake.T, dtype=np.float32)
+    pointsSave = np.empty((convergenceOrder, 2, points.shape[1]), dtype=np.float32)
+
+    # Eigenvalues of the circulant matrix A + gamma * I, where the first row is
+    # [2 * alpha + 6 * beta + gamma, -alpha - 4 * beta, beta, 0, ..., 0, beta, -alpha - 4 * beta]
+    n = points.shape[1]
+    frequencies = 2 * np.pi * np.arange(n // 2 + 1) / n
+    eigenvalues = (2 * alpha + 6 * beta + gamma) + 2 * (-alpha - 4 * beta) * np.cos(frequencies) + \
+        2 * beta * np.cos(2 * frequencies)
+
+    iteration = 0
+    for iteration in range(1, maxIterations + 1):
+        # Bilinear interpolation of the force fields at the snake points, points outside the image are clamped
+        clamped = np.clip(2 * points, 0, maximumIndex[:, None])
+        lower = np.minimum(np.floor(clamped), np.maximum(maximumIndex[:, None] - 1, 0)).astype(np.intp)
+        weight = clamped - lower
+        upper = np.minimum(lower + 1, maximumIndex[:, None].astype(np.intp))
+
+        force = np.empty_like(points)
+        for i, field in enumerate((forceX, forceY)):
+            top = field[lower[0], lower[1]] * (1 - weight[0]) + field[upper[0], lower[1]] * weight[0]
+            bottom = field[lower[0], upper[1]] * (1 - weight[0]) + field[upper[0], upper[1]] * weight[0]
+            force[i] = top * (1 - weight[1]) + bottom * weight[1]
+
+        # Solve the circulant system for both coordinates at once
+        newPoints = np.fft.irfft(np.fft.rfft(gamma * points + force, axis=1) / eigenvalues, n, axis=1)
+
+        # Movements are capped to maxPixelMove per iteration
+        points += (maxPixelMove * np.tanh(newPoints - points)).astype(np.float32)
+
+        # Convergence criteria needs to compare to a number of previous configurations since oscillations can occur
+        j = (iteration - 1) % (convergenceOrder + 1)
+        if j < convergenceOrder:
+            pointsSave[j] = points
+        else:
+            distance = np.min(np.max(np.abs(pointsSave - points[None]).sum(axis=1), axis=1))
+            if distance < convergence:
+                break
+
+    return points.T.astype(np.float64), iteration
+
+
+# Active contour engines that can be selected, each has the same parameters and approximately the same result
+activeContours = {
+    'dense': activeContour,
+    'banded': activeContourBanded,
+}
+
+
+# Scale a contour from the previous slice to fit the body outline of the current slice
+# The contour is moved and scaled along each axis so that the bounding box of the previous body outline matches the
+# bounding box of the current body outline. All contours are Nx2 arrays of (x, y) coordinates
+def scaleContour(contour, previousBodyContour, bodyContour):
+    previousMinimum, previousMaximum = previousBodyContour.min(axis=0), previousBodyContour.max(axis=0)
+    minimum, maximum = bodyContour.min(axis=0), bodyContour.max(axis=0)
+
+    scale = (maximum - minimum) / np.maximum(previousMaximum - previousMinimum, 1)
+
+    return (contour - (previousMinimum + previousMaximum) / 2) * scale + (minimum + maximum) / 2
+
+
+# Resample a closed contour to the given number of points evenly spaced along its arc length
+# The contour is an Nx2 array of (x, y) coordinates and the first point of the contour is kept
+def resampleContour(contour, numberOfPoints):
+    contour = np.asarray(contour, dtype=float)
+
+    # Arc length at each point, including the segment that closes the contour back to the first point
+    closedContour = np.vstack((contour, contour[:1]))
+    arcLength = np.concatenate(([0], np.cumsum(np.hypot(*np.diff(closedContour, axis=0).T))))
+
+    positions = np.linspace(0, arcLength[-1], numberOfPoints, endpoint=False)
+
+    return np.stack((np.interp(positions, arcLength, closedContour[:, 0]),
+                     np.interp(positions, arcLength, closedContour[:, 1])), axis=1)
+
+
+# Get the outline of the body from the body mask to use as the initial snake
+# The outline is the outer contour of the largest connected object in the body mask. If numberOfPoints is given, the
+# outline is resampled to that many points evenly spaced along its arc length so that the cost of the snake does not
+# depend on the size or shape of the body. Otherwise, the outline only contains the corners of the contour
+# Returns the outline as an Nx2 array of (x, y) coordinates
+def getBodyContour(bodyMask, numberOfPoints=None):
+    labels = skimage.measure.label(bodyMask)
+    largestLabel = np.argmax(np.bincount(labels.ravel())[1:]) + 1
+
+    # Only the contours are used from findContours since the number of values returned depends on the OpenCV version
+    contours = cv2.findContours((labels == largestLabel).astype(np.uint8), cv2.RETR_EXTERNAL,
+                                cv2.CHAIN_APPROX_NONE if numberOfPoints else cv2.CHAIN_APPROX_SIMPLE)[-2]
+    contour = max(contours, key=cv2.contourArea)
+    contour = contour.reshape(-1, 2)
+
+    if numberOfPoints:
+        contour = resampleContour(contour, numberOfPoints)
+
+    return contour
@@ -1,18 +1,172 @@
 import cv2
 import numpy as np
 import sklearn.cluster
+import time
 import cv2
 
-def kmeans(image, k, isVector=False):
+# randomState is the seed for the initial centroids, if None then the results are random
+def kmeans(image, k, isVector=False, randomState=None):
     # Flatten the image so that all of the values are in an array
     # If the image is a vector, then do not combine the last dimension
     flattenedImage = image.reshape(-1, image.shape[-1] if isVector else 1)
 
-    centroids, labels, inertia = sklearn.cluster.k_means(flattenedImage, k)
+    centroids, labels, inertia = sklearn.cluster.k_means(flattenedImage, k, random_state=randomState)
     labelOrder = np.argsort(centroids.sum(axis=1))
 
     return labelOrder, centroids, labels.reshape(image.shape[:-1] if isVector else image.shape)
 
+# Two-class K-means of each slice along the last axis of the volume using a histogram of the intensities
+# For 1D data, the optimal two-class K-means split is the threshold that maximizes the between-class variance, which is
+# the same as Otsu's method. Every threshold between the histogram bins is checked at once for all slices, so this is
+# the global optimum rather than a local optimum from random initial centroids. The centroids are the exact means of the
+# intensities in each class.
+# Returns the centroids of each slice with shape (slices, 2), sorted from smallest intensity to greatest
+def histogramCentroids(image, bins=1024):
+    # Pixels of each slice are along the first axis, the volume is not copied whether it is in C or Fortran order
+    sliceCount = image.shape[-1]
+    values = image.reshape(-1, sliceCount, order='A')
+    if not np.issubdtype(values.dtype, np.floating):
+        values = values.astype(np.float64)
+
+    # Bin the intensities using the range of each slice
+    minimum = values.min(axis=0)
+    scale = (bins / np.maximum(values.max(axis=0) - minimum, np.finfo(values.dtype).tiny)).astype(values.dtype)
+    binIndices = ((values - minimum) * scale).astype(np.intp)
+    np.clip(binIndices, 0, bins - 1, out=binIndices)
+    binIndices += np.arange(sliceCount) * bins
+
+    # Both arrays are flattened in memory order, which is the same for both
+    binIndices = binIndices.ravel(order='K')
+    counts = np.bincount(binIndices, minlength=sliceCount * bins).reshape(sliceCount, bins)
+    sums = np.bincount(binIndices, weights=values.ravel(order='K'), minlength=sliceCount * bins).reshape(sliceCount,
+                                                                                                       bins)
+
+    # Count and sum of the lower class for each threshold, the upper class is the remainder
+    lowerCounts = np.cumsum(counts, axis=1)[:, :-1]
+    lowerSums = np.cumsum(sums, axis=1)[:, :-1]
+    upperCounts = lowerCounts[:, -1:] + counts[:, -1:] - lowerCounts
+    upperSums = lowerSums[:, -1:] + sums[:, -1:] - lowerSums
+
+    # Minimizing the within-class sum of squares is the same as maximizing S1^2 / n1 + S2^2 / n2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = lowerSums ** 2 / lowerCounts + upperSums ** 2 / upperCounts
+    score[(lowerCounts == 0) | (upperCounts == 0)] = -np.inf
+
+    threshold = np.argmax(score, axis=1)[:, None]
+    lowerCount = np.take_along_axis(lowerCounts, threshold, axis=1)[:, 0]
+    upperCount = np.take_along_axis(upperCounts, threshold, axis=1)[:, 0]
+
+    # Slices with a single intensity have an empty upper class, so both centroids are that intensity
+    centroids = np.empty((sliceCount, 2))
+    centroids[:, 0] = np.take_along_axis(lowerSums, threshold, axis=1)[:, 0] / np.maximum(lowerCount, 1)
+    centroids[:, 1] = np.take_along_axis(upperSums, threshold, axis=1)[:, 0] / np.maximum(upperCount, 1)
+    centroids[upperCount == 0] = minimum[upperCount == 0, None]
+
+    return centroids
+
+# Two-class K-means of each slice along the last axis of the volume in one pass, see histogramCentroids
+# Each pixel is labelled with the nearest centroid of its slice
+# Returns the label order, centroids and labels the same as kmeans for each slice, with the slices along the first axis
+# of the label order and centroids and along the last axis of the labels
+def kmeansHistogramVolume(image, k=2, bins=1024):
+    if k != 2:
+        raise TypeError('Histogram K-means only supports two clusters')
+
+    centroids = histogramCentroids(image, bins)
+    labels = (image > centroids.mean(axis=1)).astype(np.int32)
+    labelOrder = np.tile(np.arange(2), (centroids.shape[0], 1))
+
+    return labelOrder, centroids[:, :, None], labels
+
+# Two-class K-means of an image using a histogram of the intensities, see histogramCentroids
+# Returns the same label order, centroids and labels as kmeans
+def kmeansHistogram(image, k=2, bins=1024):
+    labelOrder, centroids, labels = kmeansHistogramVolume(image[..., None], k, bins)
+
+    return labelOrder[0], centroids[0], labels[..., 0]
+
+# K-means of consecutive slices where each slice is started from the centroids of the previous slice
+# Neighbouring slices have nearly the same intensity distributions, so the previous centroids are a good starting point
+# and only a single initialization with a few iterations is needed. A full restart with random initial centroids is done
+# for the first slice and whenever the fit looks poor, which is when the inertia per pixel increases by more than
+# inertiaRatio times the previous slice or a centroid moves by more than maxDrift times the distance between the
+# previous centroids
+class WarmStartKMeans:
+    def __init__(self, k=2, maxIterations=20, inertiaRatio=2.0, maxDrift=0.25, randomState=None):
+        self.k = k
+        self.maxIterations = maxIterations
+        self.inertiaRatio = inertiaRatio
+        self.maxDrift = maxDrift
+        self.randomState = randomState
+
+        self.centroids = None
+        self.inertia = None
+        self.restarts = 0
+
+    # Returns the same label order, centroids and labels as kmeans
+    def fit(self, image, isVector=False):
+        flattenedImage = image.reshape(-1, image.shape[-1] if isVector else 1)
+
+        result = None
+        if self.centroids is not None:
+            centroids, labels, inertia = sklearn.cluster.k_means(flattenedImage, self.k, init=self.centroids, n_init=1,
+                                                                 max_iter=self.maxIterations)
+            inertia /= len(flattenedImage)
+
+            spread = np.ptp(self.centroids.sum(axis=1))
+            drift = np.abs(centroids - self.centroids).max()
+            if inertia <= self.inertiaRatio * self.inertia and drift <= self.maxDrift * spread:
+                result = centroids, labels, inertia
+
+        if result is None:
+            centroids, labels, inertia = sklearn.cluster.k_means(flattenedImage, self.k, random_state=self.randomState)
+            result = centroids, labels, inertia / len(flattenedImage)
+            self.restarts += 1
+
+        self.centroids, labels, self.inertia = result
+        labelOrder = np.argsort(self.centroids.sum(axis=1))
+
+        return labelOrder, self.centroids, labels.reshape(image.shape[:-1] if isVector else image.shape)
+
+# Bounding box of the nonzero pixels along the first two axes of a mask plus a margin on each side
+# For a volume, the bounding box contains the nonzero pixels of every slice along the last axis
+# Returns a tuple of the row and column slices, or None if the mask is empty
+def getMaskRegion(mask, margin=0):
+    rows = np.flatnonzero(mask.any(axis=tuple(x for x in range(mask.ndim) if x != 0)))
+    if len(rows) == 0:
+        return None
+
+    columns = np.flatnonzero(mask.any(axis=tuple(x for x in range(mask.ndim) if x != 1)))
+
+    return (slice(max(rows[0] - margin, 0), min(rows[-1] + 1 + margin, mask.shape[0])),
+            slice(max(columns[0] - margin, 0), min(columns[-1] + 1 + margin, mask.shape[1])))
+
+# Paste the mask of a region from getMaskRegion into an empty image with the given shape
+# The mask is returned as is if it is already the same shape as the image
+def pasteRegion(mask, region, shape):
+    if mask.shape == tuple(shape):
+        return mask
+
+    image = np.zeros(shape, mask.dtype)
+    image[region] = mask
+
+    return image
+
+# Dice coefficient of two boolean masks, two empty masks are a perfect match
+def dice(mask1, mask2):
+    total = mask1.sum() + mask2.sum()
+
+    return 1.0 if total == 0 else 2 * np.logical_and(mask1, mask2).sum() / total
+
+# Call the function with the given arguments and measure how long it takes
+# Returns the result of the function and the time in seconds
+def timeFunction(function, *args, **kwargs):
+    tic = time.perf_counter()
+    result = function(*args, **kwargs)
+    toc = time.perf_counter()
+
+    return result, toc - tic
+
 def fuseImageFalseColor(image1, image2):
     result = np.dstack((image2, image1, image2))
 